@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Binary file format for timeseries that are plotted over and over.
+
+A file starts with a fixed header:
+
+- 8 bytes: the magic string 'NENSGRPH'
+- uint32: format version (1)
+- uint32: length of the metadata in bytes
+- uint64: number of events
+
+All numbers are little endian. Then follows the metadata, a JSON object
+with label, location_id, parameter_id and units, padded with spaces so
+that the columns start at a multiple of 8 bytes. The columns follow:
+float64 dates (matplotlib date numbers, ascending), float64 values (nan
+for missing values) and uint8 flags. Comments are not stored.
+
+BinarySource reads the columns through numpy.memmap, so only the pages
+holding the events in the requested range are read from disk, and
+processes that plot the same file share them in the OS page cache.
+"""
+from __future__ import division
+
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy
+
+from nens_graph.common import ArraySource
+from nens_graph.common import Columns
+from nens_graph.common import as_source
+
+MAGIC = b'NENSGRPH'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQ')
+METADATA = ('label', 'location_id', 'parameter_id', 'units')
+DATES_DTYPE = numpy.dtype('<f8')
+VALUES_DTYPE = numpy.dtype('<f8')
+FLAGS_DTYPE = numpy.dtype('u1')
+
+
+def write_binary(filename, timeseries, **metadata):
+    """Write timeseries to filename in the binary format.
+
+    Timeseries is anything common.as_source accepts. The label,
+    location_id, parameter_id and units are taken from the timeseries,
+    unless given as keyword arguments. The timeseries is written chunk
+    by chunk, to a temporary file that replaces filename at the end.
+    Raise ValueError if the dates are not in ascending order.
+    """
+    source = as_source(timeseries)
+    for key in METADATA:
+        metadata.setdefault(key, getattr(source, key, None))
+    text = json.dumps(dict((key, metadata[key]) for key in METADATA))
+    text += ' ' * (-(HEADER.size + len(text)) % 8)
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, temp_filename = tempfile.mkstemp(dir=directory)
+    count = 0
+    last = -numpy.inf
+    # Values and flags follow all dates, so they are buffered in
+    # temporary files while the dates are written.
+    values_file = tempfile.TemporaryFile()
+    flags_file = tempfile.TemporaryFile()
+    try:
+        with os.fdopen(handle, 'wb') as binary_file:
+            binary_file.write(HEADER.pack(MAGIC, VERSION, len(text), 0))
+            binary_file.write(text)
+            for chunk in source.get_chunks():
+                if len(chunk):
+                    if (chunk.dates[0] < last or
+                        (numpy.diff(chunk.dates) < 0).any()):
+                        raise ValueError('The dates of %s are not in '
+                                         'ascending order.' % filename)
+                    last = chunk.dates[-1]
+                binary_file.write(chunk.dates.astype(DATES_DTYPE).tostring())
+                values_file.write(
+                    chunk.values.astype(VALUES_DTYPE).tostring())
+                flags_file.write(chunk.flags.astype(FLAGS_DTYPE).tostring())
+                count += len(chunk)
+            for column_file in (values_file, flags_file):
+                column_file.seek(0)
+                shutil.copyfileobj(column_file, binary_file)
+            binary_file.seek(0)
+            binary_file.write(HEADER.pack(MAGIC, VERSION, len(text), count))
+        os.chmod(temp_filename, 0o644)
+        os.rename(temp_filename, filename)
+    except Exception:
+        os.remove(temp_filename)
+        raise
+    finally:
+        values_file.close()
+        flags_file.close()
+    return count
+
+
+class BinarySource(ArraySource):
+    """Series source for a file in the binary format.
+
+    The columns are memory mapped. The range hints are applied with a
+    binary search on the dates (see ArraySource), so only the events in
+    range (plus one on either side) are read."""
+
+    def __init__(self, filename, chunksize=None):
+        self.filename = filename
+        if chunksize is not None:
+            self.chunksize = chunksize
+        with open(filename, 'rb') as binary_file:
+            magic, version, length, count = HEADER.unpack(
+                binary_file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a version %s nens_graph binary '
+                                 'file.' % (filename, VERSION))
+            metadata = json.loads(binary_file.read(length))
+        for key in METADATA:
+            setattr(self, key, metadata.get(key))
+        self.count = count
+
+        offset = HEADER.size + length
+        dates = self._memmap(DATES_DTYPE, offset)
+        offset += count * DATES_DTYPE.itemsize
+        values = self._memmap(VALUES_DTYPE, offset)
+        offset += count * VALUES_DTYPE.itemsize
+        flags = self._memmap(FLAGS_DTYPE, offset)
+        # The dtypes match those of Columns, so nothing is copied.
+        self.columns = Columns(dates, values, flags)
+
+    def _memmap(self, dtype, offset):
+        if not self.count:
+            return numpy.empty(0, dtype=dtype)
+        return numpy.memmap(self.filename, dtype=dtype, mode='r',
+                            offset=offset, shape=(self.count,))
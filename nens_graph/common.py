@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
 
-import csv
+import functools
+import hashlib
+import json
 import math
-import iso8601
+import re
+import threading
+import numpy
 
 from matplotlib.transforms import Bbox
-from matplotlib.figure import Figure
 from matplotlib.dates import AutoDateFormatter
 from matplotlib.dates import AutoDateLocator
 from matplotlib.dates import DateFormatter
@@ -14,10 +17,9 @@ from matplotlib.dates import RRuleLocator
 from matplotlib.dates import date2num
 from matplotlib.dates import num2date
 from matplotlib.dates import rrulewrapper
-from matplotlib import _png
-
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from datetime import datetime
+from contextlib import contextmanager
+from datetime import timedelta
 from dateutil.rrule import YEARLY, MONTHLY, DAILY, HOURLY, MINUTELY, SECONDLY
 from dateutil.relativedelta import relativedelta
 
@@ -35,7 +37,333 @@ RC_PARAMS = {
     'xtick.labelsize': FONTSIZE,
     'ytick.labelsize': FONTSIZE,
     }
-matplotlib.rcParams.update(RC_PARAMS)
+
+
+# Styles
+#
+# Matplotlib reads rcParams when artists are created and drawn. Each graph
+# has its own rc params, from its fontsize and dpi, which the graph
+# methods that create or draw artists (decorated with styled) put in
+# rcParams while they run, and restore afterwards. A lock keeps other
+# threads out in the meantime, so graphs with different styles can be
+# built and rendered in several threads. Outside those methods,
+# RC_PARAMS are the defaults, like they were when they were set at
+# import: they are set when the first graph is created.
+
+_style_lock = threading.RLock()
+_defaults = []
+
+
+def set_defaults():
+    """Make RC_PARAMS matplotlib's defaults, once per process."""
+    with _style_lock:
+        if not _defaults:
+            matplotlib.rcParams.update(RC_PARAMS)
+            _defaults.append(True)
+
+
+@contextmanager
+def style_context(rc):
+    """Apply rc params within the with block, and hold the style lock.
+
+    Rc must be validated already, see graph_rc. Nested contexts add to the
+    outer ones. Other threads wait at their own style_context meanwhile,
+    so keep the block short and don't wait for other threads in it."""
+    with _style_lock:
+        params = dict.__getitem__  # Skip the deprecation checks.
+        saved = dict((key, params(matplotlib.rcParams, key))
+                     for key in rc)
+        dict.update(matplotlib.rcParams, rc)
+        try:
+            yield
+        finally:
+            dict.update(matplotlib.rcParams, saved)
+
+
+def graph_rc(fontsize=FONTSIZE, dpi=DPI):
+    """Return the validated rc params for a graph: RC_PARAMS with
+    fontsize, and dpi for both the figure and saving it."""
+    rc = dict((key, fontsize) for key in RC_PARAMS
+              if key in matplotlib.RcParams.validate)
+    rc['figure.dpi'] = dpi
+    rc['savefig.dpi'] = dpi
+    return dict(matplotlib.RcParams(rc))
+
+
+def styled(method):
+    """Decorator for graph methods that create or draw artists: run them
+    in the style of the graph (its rc attribute). Constructors run before
+    rc is set, they get the style of their fontsize and dpi arguments."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        set_defaults()
+        rc = getattr(self, 'rc', None)
+        if rc is None:
+            rc = graph_rc(fontsize=kwargs.get('fontsize', FONTSIZE),
+                          dpi=kwargs.get('dpi', DPI))
+        with style_context(rc):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _render(graph, format=None):
+    # Graphs finish their layout in png_response.
+    if format is None:
+        graph.png_response()
+        return graph.responseobject
+    return graph.render(format=format)
+
+
+def render_graphs(graphs, threads=None, format=None):
+    """Render graphs in a pool of threads and return their responses.
+
+    Graphs are rendered with png_response, or with render if a format is
+    given. Graphs without a responseobject are rendered to BytesIO
+    objects.
+    Building the graphs is up to the caller, it can be done in any
+    thread, see styled. Drawing holds the style lock, and matplotlib's
+    Agg backend and png writer don't release the GIL, so the graphs are
+    drawn one at a time: this is a safe way to render from several
+    threads, not a faster one. Threads defaults to the number of cores.
+    """
+    from io import BytesIO
+    from multiprocessing.pool import ThreadPool
+
+    for graph in graphs:
+        if graph.responseobject is None:
+            graph.responseobject = BytesIO()
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(functools.partial(_render, format=format), graphs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Text metrics
+#
+# Layout code needs the size of texts before they are drawn. The extents
+# of strings are measured with a renderer that draws nothing, and cached
+# by string, font and dpi, so that labels that are in many graphs are
+# measured once per process. Matplotlib's font objects are shared by all
+# renderers, so measuring holds the style lock.
+
+TEXT_EXTENTS_SIZE = 10000
+_text_extents = {}
+_measuring = {}
+
+
+def font_key(prop):
+    """Return a hashable key for the properties of a FontProperties."""
+    return (tuple(prop.get_family()), prop.get_style(), prop.get_variant(),
+            prop.get_weight(), prop.get_stretch(),
+            prop.get_size_in_points(), prop.get_file())
+
+
+def text_extent(text, prop=None, dpi=DPI):
+    """Return (width, height, descent) in pixels of a line of text in font
+    prop (default: the current default font) at dpi."""
+    from matplotlib.text import Text
+    if prop is None:
+        from matplotlib.font_manager import FontProperties
+        prop = FontProperties()
+    key = (text, font_key(prop), dpi)
+    extent = _text_extents.get(key)
+    if extent is None:
+        clean, ismath = Text.is_math_text(text)
+        with _style_lock:
+            if dpi not in _measuring:
+                from matplotlib.backends.backend_agg import RendererAgg
+                _measuring[dpi] = RendererAgg(1, 1, dpi)
+            extent = _measuring[dpi].get_text_width_height_descent(
+                clean, prop, ismath=ismath)
+        if len(_text_extents) >= TEXT_EXTENTS_SIZE:
+            _text_extents.clear()
+        _text_extents[key] = extent
+    return extent
+
+
+def text_width(text, prop=None, dpi=DPI):
+    """Return the width in pixels of (multiline) text, see text_extent."""
+    return max(text_extent(line, prop, dpi)[0] if line else 0
+               for line in text.split('\n'))
+
+
+def truncate_text(text, width, prop=None, dpi=DPI):
+    """Return the longest start of text that is at most width pixels wide,
+    found by bisection on measured widths."""
+    if text_width(text, prop, dpi) <= width:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if text_width(text[:mid], prop, dpi) <= width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def legend_items(handles, labels, remove_duplicates=False,
+                 reversed_items=None, max_items=None):
+    """Return new lists of handles and labels for a legend.
+
+    - reversed_items: indexes of items whose order is reversed among
+      themselves
+    - remove_duplicates: only the last item with a label is kept
+    - max_items: when there are more items, the last one that is kept
+      says how many are left out
+
+    Handles and labels are not changed, and each step takes time linear
+    in the number of items."""
+    handles, labels = list(handles), list(labels)
+    if reversed_items:
+        reversed_items = list(reversed_items)
+        items = [(handles[i], labels[i]) for i in reversed(reversed_items)]
+        for index, (handle, label) in zip(reversed_items, items):
+            handles[index] = handle
+            labels[index] = label
+    if remove_duplicates:
+        last = dict((label, index) for index, label in enumerate(labels))
+        keep = [index for index, label in enumerate(labels)
+                if last[label] == index]
+        handles = [handles[index] for index in keep]
+        labels = [labels[index] for index in keep]
+    if max_items and len(labels) > max_items:
+        from matplotlib.patches import Patch
+        more = len(labels) - max_items + 1
+        handles = handles[:max_items - 1] + [
+            Patch(facecolor='none', edgecolor='none')]
+        labels = labels[:max_items - 1] + ['%d more' % more]
+    return handles, labels
+
+
+def _hex_color(color):
+    """Return color as '#rrggbb', or 'none' when it is transparent."""
+    from matplotlib.colors import colorConverter
+    from matplotlib.colors import rgb2hex
+    rgba = colorConverter.to_rgba(color)
+    if not rgba[3]:
+        return 'none'
+    return rgb2hex(rgba[:3])
+
+
+def legend_entry(handle, label):
+    """Return a dict describing a legend item, for clients that draw
+    the legend themselves, or for LegendGraph.
+
+    Lines become {'type': 'line'} with color, linestyle, linewidth,
+    marker and markersize, anything else {'type': 'patch'} with
+    facecolor, edgecolor and hatch. Both have a label and an alpha."""
+    from matplotlib.collections import Collection
+    from matplotlib.collections import LineCollection
+    from matplotlib.container import Container
+    from matplotlib.lines import Line2D
+    if isinstance(handle, Container) and len(handle):
+        handle = handle[0]
+    entry = {'label': label, 'alpha': handle.get_alpha()}
+    if isinstance(handle, Line2D):
+        entry.update(type='line',
+                     color=_hex_color(handle.get_color()),
+                     linestyle=handle.get_linestyle(),
+                     linewidth=handle.get_linewidth(),
+                     marker=handle.get_marker(),
+                     markersize=handle.get_markersize())
+    elif isinstance(handle, LineCollection):
+        colors = handle.get_colors()
+        entry.update(type='line',
+                     color=_hex_color(colors[0] if len(colors) else 'none'),
+                     linestyle='-',
+                     linewidth=handle.get_linewidths()[0],
+                     marker='None',
+                     markersize=0)
+    else:
+        if isinstance(handle, Collection):
+            facecolors = handle.get_facecolor()
+            edgecolors = handle.get_edgecolor()
+            facecolor = facecolors[0] if len(facecolors) else 'none'
+            edgecolor = edgecolors[0] if len(edgecolors) else 'none'
+        else:
+            facecolor = handle.get_facecolor()
+            edgecolor = handle.get_edgecolor()
+        entry.update(type='patch',
+                     facecolor=_hex_color(facecolor),
+                     edgecolor=_hex_color(edgecolor),
+                     hatch=handle.get_hatch())
+    return entry
+
+
+def legend_handle(entry):
+    """Return a legend handle (an artist) for a legend_entry dict."""
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Patch
+    if entry['type'] == 'line':
+        return Line2D([], [],
+                      color=entry['color'],
+                      linestyle=entry['linestyle'],
+                      linewidth=entry['linewidth'],
+                      marker=entry['marker'],
+                      markersize=entry['markersize'],
+                      alpha=entry['alpha'])
+    return Patch(facecolor=entry['facecolor'],
+                 edgecolor=entry['edgecolor'],
+                 hatch=entry['hatch'],
+                 alpha=entry['alpha'])
+
+
+# Layouts
+#
+# Graphs that measure their texts to lay themselves out (see on_draw) can
+# cache the result by a signature of everything it depends on, see
+# NensGraph.layout_signature. Later graphs with the same signature get
+# the cached layout before they are drawn, and are drawn only once.
+
+LAYOUT_CACHE_SIZE = 10000
+_layouts = {}
+
+# Backgrounds
+#
+# Graphs that share everything but a few artists can be rendered over a
+# cached pixel buffer of the rest, see NensGraph.render_blitted. Buffers
+# take width * height * 4 bytes each, hence the small cache.
+
+BACKGROUNDS_SIZE = 64
+_backgrounds = {}
+
+
+def write_png(renderer, response, dpi=DPI):
+    """Write the pixels of an Agg renderer to response as png, without
+    drawing a figure on it first, as canvas.print_png would."""
+    from matplotlib import _png
+    _png.write_png(renderer._renderer, response, dpi)
+
+
+def warmup():
+    """Load everything the first graph would otherwise load.
+
+    The Agg backend, the figure machinery and a few other modules are
+    imported on first use, so that importing nens_graph is cheap for
+    processes that don't render. A server that forks its workers should
+    call warmup() once in the parent process instead: the modules, the
+    font list and the fonts used by the default style are then loaded
+    and shared by all workers.
+
+    Importing nens_graph.common itself still loads numpy, matplotlib and
+    matplotlib.dates (about 0.2s), as its date locator and formatter
+    subclass those of matplotlib."""
+    import csv  # noqa, for csv responses, imported to load it only
+    import iso8601
+    from io import BytesIO
+    from matplotlib import font_manager
+
+    # Fallback of parse_dates, compiles its regular expressions.
+    iso8601.parse_date('2000-01-01T00:00:00Z')
+    font_manager.findfont(font_manager.FontProperties(size=FONTSIZE))
+    graph = DateGridGraph(width=160, height=120)
+    graph.axes.plot(date2num([datetime(2000, 1, 1), datetime(2000, 1, 2)]),
+                    [0, 1], label='warmup')
+    graph.legend()
+    graph.png_response(BytesIO())
 
 
 class NensGraph(object):
@@ -48,50 +376,108 @@ class NensGraph(object):
     - height (optional, default: 480)
     - fontsize (optional, default: 10)
     - dpi (optional, default: 72)
+
+    Fontsize and dpi end up in the rc attribute, which is applied while
+    the graph creates and draws its artists, see styled. Text added to
+    the axes of a graph directly gets the defaults (RC_PARAMS), unless it
+    is added in a ``with style_context(graph.rc):`` block. Graphs can be
+    built and rendered in several threads, see render_graphs.
     """
+    rc = None
 
+    @styled
     def __init__(self, **kwargs):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
         self.drawn = False
+        self.finished = False
         self.responseobject = None
         self.width = kwargs.get('width', 640)
         self.height = kwargs.get('height', 480)
         self.fontsize = kwargs.get('fontsize', FONTSIZE)
         self.dpi = kwargs.get('dpi', DPI)
+        self.rc = graph_rc(fontsize=self.fontsize, dpi=self.dpi)
 
         inches_from_pixels = Converter(dpi=self.dpi).inches_from_pixels
         self.figure = Figure(figsize=(inches_from_pixels(self.width),
                                       inches_from_pixels(self.height)),
                              dpi=self.dpi,
                              facecolor='#ffffff')
-        FigureCanvas(self.figure)
+        FigureCanvasAgg(self.figure)
         self.renderer = self.figure.canvas.get_renderer()
+        self.dynamic_artists = []
 
     def object_width(self, objects):
         """Return width in figure coordinates of union of objects.
        The objects should support the get_window_extent()-method. Intended for
        use in the context of the on_draw method."""
-        bboxes = []
-        for o in objects:
-            bbox = o.get_window_extent(renderer=self.renderer)
-            # get_window_extent() gives pixels, we need figure coordinates:
-            bboxi = bbox.inverse_transformed(self.figure.transFigure)
-            bboxes.append(bboxi)
-        bbox = Bbox.union(bboxes)
-        return bbox.width
+        return self.object_size(objects)[0]
 
     def object_height(self, objects):
         """Return height in figure coordinates of union of objects.
        The objects should support the get_window_extent()-method. Intended for
        use in the context of the on_draw method."""
+        return self.object_size(objects)[1]
+
+    def object_size(self, objects):
+        """Return (width, height) in figure coordinates of union of objects.
+
+        The size of a single line of text, horizontal or vertical, comes
+        from the text metrics cache (see text_extent), other objects are
+        measured with get_window_extent()."""
+        figure_width, figure_height = self.figure.bbox.size
+        if len(objects) == 1:
+            size = self.text_size(objects[0])
+            if size is not None:
+                return size[0] / figure_width, size[1] / figure_height
         bboxes = []
         for o in objects:
-            bbox = o.get_window_extent()
-            bbox = o.get_window_extent()
+            bbox = o.get_window_extent(renderer=self.renderer)
             # get_window_extent() gives pixels, we need figure coordinates:
             bboxi = bbox.inverse_transformed(self.figure.transFigure)
             bboxes.append(bboxi)
         bbox = Bbox.union(bboxes)
-        return bbox.height
+        return bbox.width, bbox.height
+
+    def text_size(self, text):
+        """Return (width, height) in pixels of a matplotlib Text like its
+        get_window_extent would, or None if it is not a visible, single
+        line, horizontal or vertical, non-TeX text."""
+        from matplotlib.text import Text
+        if not isinstance(text, Text) or not text.get_visible():
+            return None
+        string = text.get_text()
+        rotation = text.get_rotation()
+        if (not string or '\n' in string or text.get_usetex() or
+            rotation not in (0, 90)):
+            return None
+        prop = text.get_fontproperties()
+        width, height = text_extent(string, prop, self.dpi)[:2]
+        # Text layout makes lines at least as high as 'lp'.
+        height = max(height, text_extent('lp', prop, self.dpi)[1])
+        if rotation == 90:
+            return height, width
+        return width, height
+
+    def truncate_labels(self, labels, ncol, width=None):
+        """Return legend labels cut to the width of a legend column.
+
+        Width is the width of the legend in pixels, default the width of
+        the graph. The space of the handles, paddings and spacing between
+        the columns comes from the legend rc params."""
+        from matplotlib.font_manager import FontProperties
+        if width is None:
+            width = self.width
+        rc = matplotlib.rcParams
+        prop = FontProperties(size=rc['legend.fontsize'])
+        em = prop.get_size_in_points() * self.dpi / 72
+        column_width = (
+            (width - em * (2 * rc['legend.borderpad'] +
+                           (ncol - 1) * rc['legend.columnspacing'])) / ncol -
+            em * (rc['legend.handlelength'] + rc['legend.handletextpad']))
+        return [truncate_text(label, column_width, prop, self.dpi)
+                for label in labels]
 
     def ticklabel_bbox(self, axis):
         """Return bbox in figure-coordinates of ticklabels."""
@@ -101,11 +487,13 @@ class NensGraph(object):
 
     def on_draw_wrapper(self, event):
         """Avoid entering a loop, and avoid it here so that the inheriting
-        classes don't have to bother."""
+        classes don't have to bother. The figure is drawn again only if
+        on_draw may have changed something."""
         if not self.drawn:
-            self.on_draw()
+            changed = self.on_draw()
             self.drawn = True
-            self.figure.canvas.draw()
+            if changed is not False:
+                self.figure.canvas.draw()
         return False
 
     def get_width_from_pixels(self, pixels):
@@ -119,8 +507,79 @@ class NensGraph(object):
     def on_draw(self):
         """Override this method for last minute tweaks to the layout. The
         above methods object width and object height only make sense in the
-        context of this method."""
-        pass
+        context of this method.
+
+        Return False if nothing changed, to skip drawing the figure again.
+        """
+        return False
+
+    def layout_signature(self):
+        """Return a hashable signature of everything the layout made by
+        on_draw depends on, or None (the default) to not cache layouts.
+
+        Called just before drawing. A graph that returns a signature must
+        pass the layout it makes in on_draw to store_layout, and handle it
+        in apply_layout."""
+        return None
+
+    def layout_key(self, *items):
+        """Return a signature of items and the size and style of the
+        graph, for layout_signature."""
+        return ((type(self).__name__, self.width, self.height, self.dpi,
+                 tuple(sorted(self.rc.items()))) + items)
+
+    def text_signature(self, text):
+        """Return what the layout needs to know of a Text (or None): its
+        size, or its string and font when it can't be measured directly.
+        """
+        if text is None:
+            return None
+        size = self.text_size(text)
+        if size is not None:
+            return size
+        return (text.get_text(), text.get_rotation(),
+                font_key(text.get_fontproperties()))
+
+    def tick_signature(self, axis):
+        """Return (number of lines, width, line height) of the largest
+        major tick labels that axis will draw, without drawing."""
+        low, high = sorted(axis.get_view_interval())
+        locs = [loc for loc in axis.get_major_locator()()
+                if low <= loc <= high]
+        formatter = axis.get_major_formatter()
+        formatter.set_locs(locs)
+        labels = [formatter(loc, i) for i, loc in enumerate(locs)]
+        if not labels:
+            return None
+        prop = axis.get_major_ticks()[0].label1.get_fontproperties()
+        return (max(label.count('\n') + 1 for label in labels),
+                max(text_width(label, prop, self.dpi) for label in labels),
+                text_extent('lp', prop, self.dpi)[1])
+
+    def store_layout(self, layout):
+        """Cache layout (made in on_draw) for graphs with the same
+        layout signature."""
+        key = getattr(self, 'layout_cache_key', None)
+        if key is None:
+            return
+        if len(_layouts) >= LAYOUT_CACHE_SIZE:
+            _layouts.clear()
+        _layouts[key] = layout
+
+    def apply_layout(self, layout):
+        """Apply a layout dict: 'axes' position, 'suptitle' position,
+        'legend' anchor (figure coordinates) and 'legend_labels'."""
+        self.axes.set_position(layout['axes'])
+        suptitle = getattr(self, 'suptitle_obj', None)
+        if suptitle is not None and layout.get('suptitle'):
+            suptitle.set_position(layout['suptitle'])
+        legend = getattr(self, 'legend_obj', None)
+        if legend is not None and layout.get('legend'):
+            legend.set_bbox_to_anchor(layout['legend'],
+                                      transform=self.figure.transFigure)
+            for text, label in zip(legend.get_texts(),
+                                   layout['legend_labels']):
+                text.set_text(label)
 
     # def print_png(self, canvas, filename_or_obj, *args, **kwargs):
     #     """Copied from matplotlib backend_agg and modified"""
@@ -136,6 +595,7 @@ class NensGraph(object):
     #                    filename_or_obj, canvas.figure.dpi)
     #     renderer.dpi = original_dpi
 
+    @styled
     def render(self, response=None, format=None):
         """
         Generate png response.
@@ -151,10 +611,7 @@ class NensGraph(object):
         if response is None:
             raise TypeError('Expected response object, not None.')
 
-        # The renderer is used to audit the size of certain graph elements in
-        # the functions object_width and object_height above.
-
-        self.figure.canvas.mpl_connect('draw_event', self.on_draw_wrapper)
+        self.prepare_draw()
         if format == 'bmp':  # Doesn't work?
             self.figure.canvas.print_bmp(response)
         elif format == 'emf':  # Requires pyemf
@@ -184,6 +641,134 @@ class NensGraph(object):
             self.figure.canvas.print_png(response)
         return response
 
+    def prepare_draw(self):
+        """Apply a cached layout, if any, and have on_draw called when
+        the figure is drawn.
+
+        Subclasses that finish their graph before it is drawn (limits,
+        locators, legend) do so in an override of this method, before
+        calling it, and only while self.finished is False: this method
+        is called on every render."""
+        self.finished = True
+        # A cached layout makes measuring (in on_draw) unnecessary.
+        self.layout_cache_key = None
+        if not self.drawn:
+            self.layout_cache_key = self.layout_signature()
+            if self.layout_cache_key is not None:
+                layout = _layouts.get(self.layout_cache_key)
+                if layout is not None:
+                    self.apply_layout(layout)
+                    self.drawn = True
+
+        # The renderer is used to audit the size of certain graph elements in
+        # the functions object_width and object_height above.
+
+        self.figure.canvas.mpl_connect('draw_event', self.on_draw_wrapper)
+
+    def set_dynamic(self, *artists):
+        """Mark artists as dynamic for render_blitted. Without artists,
+        all lines, collections and patches in the axes are marked."""
+        if not artists:
+            artists = [artist for axes in self.figure.axes
+                       for artist in axes.lines + axes.collections +
+                       axes.patches]
+        self.dynamic_artists.extend(artists)
+
+    def overlay_artists(self):
+        """Return the artists that render_blitted draws over the
+        background, in drawing order.
+
+        Per axes, these are the dynamic artists and everything that
+        axes.draw draws after the first of them, by zorder. The axis (and
+        grid) of an axes is drawn above its lines, unless it is set to be
+        below them with axes.set_axisbelow. Dynamic artists outside the
+        axes come last."""
+        overlay = []
+        dynamic = set(self.dynamic_artists)
+        for axes in sorted(self.figure.axes, key=lambda axes: axes.zorder):
+            # The same selection as axes.draw.
+            children = axes.get_children()
+            children.remove(axes.patch)
+            if not (axes.axison and axes.get_frame_on()):
+                children = [child for child in children
+                            if child not in axes.spines.values()]
+            if axes.axison:
+                zorder = 0.5 if axes.get_axisbelow() else 2.5
+                axes.xaxis.set_zorder(zorder)
+                axes.yaxis.set_zorder(zorder)
+            else:
+                children.remove(axes.xaxis)
+                children.remove(axes.yaxis)
+            if len(axes.images) > 1:
+                children = [child for child in children
+                            if child not in axes.images]
+            children.sort(key=lambda child: child.zorder)
+            for i, child in enumerate(children):
+                if child in dynamic:
+                    overlay.extend(children[i:])
+                    break
+        drawn = set(overlay)
+        overlay.extend(artist for artist in self.dynamic_artists
+                       if artist not in drawn)
+        return overlay
+
+    @styled
+    def render_blitted(self, background_key, response=None):
+        """Render a png of the graph over a cached background.
+
+        The background is everything but the dynamic artists (see
+        set_dynamic). It is drawn for the first graph with a
+        background_key, and kept as a pixel buffer, along with the
+        positions of the axes. Later graphs with the same key copy the
+        buffer and draw only their dynamic artists over it, without
+        laying themselves out.
+
+        Background_key must identify everything in the background: the
+        class, size and style of the graph, the axes limits, labels,
+        legend and the static artists. Static artists with a higher
+        zorder than the dynamic artists, see overlay_artists, are left
+        out of the background and drawn again over them, so that the
+        result looks like a full render. Most of the time is saved when
+        the dynamic artists are on top (a zorder above the legend and
+        the axis), so that only they are drawn."""
+        if response is None:
+            response = self.responseobject
+        if response is None:
+            raise TypeError('Expected response object, not None.')
+
+        canvas = self.figure.canvas
+        self.prepare_draw()
+        overlay = self.overlay_artists()
+        background = _backgrounds.get(background_key)
+        if background is None:
+            animated = [artist.get_animated() for artist in overlay]
+            for artist in overlay:
+                artist.set_animated(True)
+            try:
+                canvas.draw()
+            finally:
+                for artist, flag in zip(overlay, animated):
+                    artist.set_animated(flag)
+            renderer = canvas.get_renderer()
+            background = (canvas.copy_from_bbox(self.figure.bbox),
+                          [axes.get_position().bounds
+                           for axes in self.figure.axes])
+            if len(_backgrounds) >= BACKGROUNDS_SIZE:
+                _backgrounds.clear()
+            _backgrounds[background_key] = background
+        else:
+            region, positions = background
+            for axes, position in zip(self.figure.axes, positions):
+                axes.set_position(position)
+            self.drawn = True
+            renderer = canvas.get_renderer()
+            renderer.restore_region(region)
+
+        for artist in overlay:
+            artist.draw(renderer)
+        write_png(renderer, response, self.dpi)
+        return response
+
     def png_response(self, response=None):
         """
         Generate png response.
@@ -247,6 +832,827 @@ def dates_values(timeseries, request_dates=None):
     return dates, values, flag_dates, flag_values
 
 
+# Dates
+#
+# Matplotlib draws dates as date numbers: floats counting days. Converting
+# datetime objects one by one with date2num is slow for long series, so
+# the functions below take numpy datetime64 arrays or date numbers as well
+# and convert those in one go.
+
+EPOCH = date2num(datetime(1970, 1, 1))
+ONE_DAY = numpy.timedelta64(1, 'D')
+
+
+def to_datenums(dates, tz=None):
+    """Return matplotlib date numbers for dates.
+
+    Dates can be a single date or a sequence or array of dates. Dates
+    can be datetimes, numpy datetime64 values or date numbers (floats),
+    which are returned unchanged. NaT becomes nan.
+
+    Iso8601 strings are accepted as well, see parse_dates.
+
+    Datetime64 values carry no timezone. They are taken as local times in
+    tz if tz is given, and as UTC otherwise. The same goes for strings
+    without a timezone. Naive datetimes are taken as UTC, like date2num
+    does.
+    """
+    scalar = numpy.ndim(dates) == 0
+    array = numpy.asarray(dates)
+    if array.dtype.kind in 'fiu':
+        datenums = array.astype(numpy.float64)
+    elif array.dtype.kind == 'M':
+        datenums = (array.astype('datetime64[us]') -
+                    numpy.datetime64(0, 'us')) / ONE_DAY + EPOCH
+        if tz is not None:
+            datenums = datenums - utc_offsets(datenums, tz, local=True)
+    elif array.dtype.kind in 'SU':
+        datenums = to_datenums(parse_dates(array, tz=tz))
+    else:
+        datenums = numpy.asarray(date2num(array.tolist()),
+                                 dtype=numpy.float64)
+    if scalar:
+        return float(datenums)
+    return datenums
+
+
+def utc_offsets(datenums, tz, local=False):
+    """Return the utc offsets of tz in days at datenums.
+
+    The offset is only determined once per day in the range of datenums,
+    and for the exact moments of change on days where it changes. The
+    offsets of all datenums are then looked up at once.
+
+    If local is True, datenums are local times in tz instead of UTC.
+    """
+    datenums = numpy.asarray(datenums, dtype=numpy.float64)
+    offsets = numpy.zeros(datenums.shape)
+    valid = ~numpy.isnan(datenums)
+    if not valid.any():
+        return offsets
+
+    def offset(datenum):
+        delta = num2date(datenum, tz).utcoffset()
+        return (delta.days * 86400 + delta.seconds) / 86400
+
+    days = numpy.arange(math.floor(datenums[valid].min()) - 2,
+                        math.ceil(datenums[valid].max()) + 3)
+    day_offsets = [offset(day) for day in days]
+    changes = [0]
+    change_offsets = [day_offsets[0]]
+    for i in range(1, len(days)):
+        if day_offsets[i] == day_offsets[i - 1]:
+            continue
+        # Find the moment of change to a second.
+        lo, hi = days[i - 1], days[i]
+        while hi - lo > 1 / 86400:
+            mid = (lo + hi) / 2
+            if offset(mid) == day_offsets[i - 1]:
+                lo = mid
+            else:
+                hi = mid
+        changes.append(hi)
+        change_offsets.append(day_offsets[i])
+    changes = numpy.array(changes)
+    change_offsets = numpy.array(change_offsets)
+
+    utc = datenums[valid]
+    if local:
+        # Local times to UTC: two passes settle the offset, except in the
+        # hour that is skipped or repeated when the offset changes.
+        for i in range(2):
+            index = numpy.searchsorted(changes, utc, side='right') - 1
+            utc = datenums[valid] - change_offsets[numpy.maximum(index, 0)]
+    index = numpy.searchsorted(changes, utc, side='right') - 1
+    offsets[valid] = change_offsets[numpy.maximum(index, 0)]
+    return offsets
+
+
+def to_days(delta):
+    """Return a timedelta, a numpy timedelta64 or an array of those in
+    days. Numbers are returned unchanged."""
+    if isinstance(delta, timedelta):
+        return delta.total_seconds() / 86400
+    array = numpy.asarray(delta)
+    if array.dtype.kind == 'm':
+        return array / ONE_DAY
+    if array.dtype.kind in 'fiu':
+        return delta
+    if array.ndim:
+        return numpy.array([to_days(d) for d in array.flat]).reshape(
+            array.shape)
+    raise TypeError('Cannot convert %r to days.' % (delta,))
+
+
+ISO8601_REGEX = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?)?'
+    r'(?:(Z)|([+-])(\d{2})(?::?(\d{2}))?)?$')
+# A timezone only follows a time, '-01' in '2012-01' is a month.
+ISO8601_TIMEZONE_REGEX = re.compile(
+    r'[T ][\d:.,]+(Z|[+-]\d{2}(:?\d{2})?)$')
+NAT = numpy.datetime64('NaT', 'us')
+
+
+def parse_dates(strings, tz=None, invalid='raise'):
+    """Return a datetime64[us] array (UTC) for iso8601 date strings.
+
+    Strings of the same length usually have the same format. For each
+    length, the format of the first string is determined, and all strings
+    in that format are parsed at once as arrays of digits. Strings in a
+    different format go through iso8601.parse_date one by one. Strings
+    that can not be parsed raise its ParseError (a ValueError), or
+    become NaT if invalid is 'nat'.
+
+    Strings without a timezone are taken as local times in tz if tz is
+    given, and as UTC otherwise, like iso8601.parse_date does.
+    """
+    strings = numpy.asarray(list(strings) if not hasattr(strings, '__len__')
+                            else strings)
+    if strings.dtype.kind == 'U':
+        try:
+            strings = strings.astype('S')
+        except UnicodeEncodeError:
+            strings = strings.astype(object)
+    if strings.dtype.kind != 'S':
+        strings = numpy.array([str(s) for s in strings.flat]).reshape(
+            strings.shape)
+    strings = numpy.char.strip(strings)
+    result = numpy.empty(strings.shape, dtype='datetime64[us]')
+    result.fill(NAT)
+    naive = numpy.zeros(strings.shape, dtype=bool)
+    todo = numpy.ones(strings.shape, dtype=bool)
+
+    lengths = numpy.char.str_len(strings)
+    for length in numpy.unique(lengths):
+        selection = numpy.flatnonzero(lengths == length)
+        sample = strings.flat[selection[0]]
+        match = ISO8601_REGEX.match(sample)
+        if not match:
+            continue
+        block = strings.flat[selection].astype('S%d' % length).view(
+            numpy.uint8).reshape(-1, length)
+        parsed, ok = _parse_block(block, sample, match)
+        result.flat[selection[ok]] = parsed[ok]
+        naive.flat[selection[ok]] = match.group(8, 9) == (None, None)
+        todo.flat[selection[ok]] = False
+
+    if todo.any():
+        import iso8601
+    for i in numpy.flatnonzero(todo):
+        try:
+            dt = iso8601.parse_date(strings.flat[i])
+        except (iso8601.ParseError, ValueError):
+            if invalid == 'nat':
+                continue
+            raise
+        naive.flat[i] = not ISO8601_TIMEZONE_REGEX.search(strings.flat[i])
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+        result.flat[i] = numpy.datetime64(dt, 'us')
+
+    if tz is not None and naive.any():
+        local = result[naive]
+        offsets = utc_offsets(to_datenums(local), tz, local=True)
+        result[naive] = local - numpy.round(
+            offsets * 86400e6).astype('timedelta64[us]')
+    return result
+
+
+def _parse_block(block, sample, match):
+    """Return datetime64[us] array and a mask of valid rows for the rows
+    of a (strings, characters) array of digits that have the same format
+    as sample, for which match is the ISO8601_REGEX match."""
+    digit = (block >= 48) & (block <= 57)
+    ok = numpy.ones(len(block), dtype=bool)
+    # All characters that are not digits should be equal to those of the
+    # sample, except for the sign of the timezone.
+    characters = numpy.frombuffer(sample, dtype=numpy.uint8)
+    separators = (characters < 48) | (characters > 57)
+    fixed = separators.copy()
+    if match.group(9):
+        # The sign is a separator that may differ from the sample's.
+        fixed[match.start(9)] = False
+        ok &= (block[:, match.start(9)] == 43) | (
+            block[:, match.start(9)] == 45)
+    ok &= digit[:, ~separators].all(axis=1)
+    ok &= (block[:, fixed] == characters[fixed]).all(axis=1)
+
+    def number(group):
+        if match.group(group) is None:
+            return numpy.zeros(len(block), dtype=numpy.int64)
+        start, end = match.span(group)
+        digits = block[:, start:end].astype(numpy.int64) - 48
+        return digits.dot(10 ** numpy.arange(end - start - 1, -1, -1))
+
+    years = number(1)
+    months = number(2)
+    days = number(3)
+    ok &= (months >= 1) & (months <= 12) & (days >= 1)
+    months = numpy.where(ok, months, 1)
+    month_starts = ((years - 1970).astype('datetime64[Y]') +
+                    (months - 1).astype('timedelta64[M]'))
+    month_lengths = ((month_starts + 1).astype('datetime64[D]') -
+                     month_starts.astype('datetime64[D]')).astype(
+        numpy.int64)
+    ok &= days <= month_lengths
+    hours = number(4)
+    minutes = number(5)
+    seconds = number(6)
+    ok &= (hours < 24) & (minutes < 60) & (seconds <= 60)
+    microseconds = number(7)
+    if match.group(7) is not None:
+        ndigits = len(match.group(7))
+        if ndigits > 6:
+            microseconds //= 10 ** (ndigits - 6)
+        else:
+            microseconds *= 10 ** (6 - ndigits)
+    offset = 60 * number(10) + number(11)
+    if match.group(9):
+        offset = numpy.where(block[:, match.start(9)] == 45, -offset, offset)
+
+    result = (month_starts.astype('datetime64[D]') +
+              (days - 1).astype('timedelta64[D]')).astype('datetime64[us]')
+    result += ((((hours * 60 + minutes - offset) * 60 + seconds) *
+                1000000 + microseconds)).astype('timedelta64[us]')
+    return result, ok
+
+
+# Series sources
+#
+# The graph methods accept two kinds of timeseries. The old kind has a
+# get_events() method that yields (timestamp, (value, flag, comment))
+# tuples one by one. The new kind implements the series source protocol
+# described in SeriesSource below, and hands out events in batches of
+# columns. Use as_source() to get a series source for either kind.
+
+CHUNKSIZE = 65536
+
+
+class Columns(object):
+    """Batch of timeseries events, stored as columns.
+
+    - dates: float64 array of matplotlib date numbers, ascending
+    - values: float64 array, nan for missing values
+    - flags: uint8 array, see dates_values_comments for their meaning
+    - comments: object array, or None if the comments were not loaded
+    """
+
+    def __init__(self, dates, values, flags=None, comments=None):
+        self.dates = numpy.asarray(dates, dtype=numpy.float64)
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+        if flags is None:
+            flags = numpy.zeros(len(self.dates), dtype=numpy.uint8)
+        self.flags = numpy.asarray(flags, dtype=numpy.uint8)
+        if comments is not None:
+            comments = numpy.asarray(comments, dtype=object)
+        self.comments = comments
+
+    def __len__(self):
+        return len(self.dates)
+
+    def take(self, index):
+        """Return new Columns for index, which can be a slice, a boolean
+        mask or an array of indices."""
+        comments = None
+        if self.comments is not None:
+            comments = self.comments[index]
+        return Columns(self.dates[index],
+                       self.values[index],
+                       self.flags[index],
+                       comments)
+
+    def valid(self):
+        """Return the events that have a value."""
+        return self.take(~numpy.isnan(self.values))
+
+    def flagged(self):
+        """Return the events that are doubtful or worse (flag > 2)."""
+        return self.take(self.flags > 2)
+
+    @classmethod
+    def concatenate(cls, chunks):
+        """Return one Columns object for a sequence of chunks."""
+        chunks = list(chunks)
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            return cls(numpy.empty(0), numpy.empty(0))
+        comments = None
+        if all(c.comments is not None for c in chunks):
+            comments = numpy.concatenate([c.comments for c in chunks])
+        return cls(numpy.concatenate([c.dates for c in chunks]),
+                   numpy.concatenate([c.values for c in chunks]),
+                   numpy.concatenate([c.flags for c in chunks]),
+                   comments)
+
+
+def decimate(columns, resolution, gaps=False):
+    """Return columns reduced to at most four events per resolution-wide
+    bin: the first, lowest, highest and last event. A line through the
+    result looks the same as a line through all events, as long as the
+    resolution is not larger than a pixel.
+
+    Missing values are dropped, unless gaps is true: then the first
+    missing value of every run of them is kept, so that a line through
+    the result breaks there as well, and bins end at it. Bins are aligned
+    to multiples of the resolution, so chunks of one series can be
+    decimated separately.
+    """
+    if gaps:
+        missing = numpy.isnan(columns.values)
+        after_missing = numpy.append(False, missing[:-1])
+        columns = columns.take(~missing | ~after_missing)
+        missing = numpy.isnan(columns.values)
+        after_missing = numpy.append(False, missing[:-1])
+        # Missing values are stretches of their own.
+        stretches = numpy.cumsum(missing | after_missing)
+    else:
+        columns = columns.valid()
+        stretches = numpy.zeros(len(columns))
+    if not resolution or len(columns) <= 4:
+        return columns
+    bins = numpy.floor(columns.dates / resolution)
+    last = numpy.flatnonzero((numpy.diff(bins) != 0) |
+                             (numpy.diff(stretches) != 0))
+    if 4 * (len(last) + 1) >= len(columns):
+        return columns
+    last = numpy.append(last, len(columns) - 1)
+    first = numpy.append(0, last[:-1] + 1)
+    # Sorting by bin, then by value, puts the lowest value of each bin at
+    # its first position and the highest value at its last position.
+    order = numpy.lexsort((columns.values, bins, stretches))
+    index = numpy.concatenate((first, last, order[first], order[last]))
+    return columns.take(numpy.unique(index))
+
+
+def clip_chunks(chunks, start=None, end=None):
+    """Yield chunks restricted to the events between start and end.
+
+    One event before start and one after end are kept as well, so that
+    lines continue up to the edges of the axes.
+    """
+    previous = None
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        lo = 0
+        hi = len(chunk)
+        if start is not None:
+            lo = numpy.searchsorted(chunk.dates, start, side='left')
+        if end is not None:
+            hi = numpy.searchsorted(chunk.dates, end, side='right')
+        if lo == len(chunk):
+            # All events are before start, remember the last one.
+            previous = chunk.take(slice(-1, None))
+            continue
+        if lo > 0:
+            lo -= 1
+        elif previous is not None:
+            yield previous
+        previous = None
+        if hi < len(chunk):
+            yield chunk.take(slice(lo, hi + 1))
+            return
+        yield chunk.take(slice(lo, hi))
+
+
+def source_hints(start, end, pixels, span=None):
+    """Return the range and resolution hints for series sources (see
+    SeriesSource) for start to end shown in pixels pixels: about one
+    event per pixel. Span is the number of days along the axis, when
+    that differs from end - start (dates folded onto one month, for
+    example). Without start or end, there are no hints."""
+    if start is None or end is None:
+        return {}
+    start, end = to_datenums((start, end))
+    if span is None:
+        span = end - start
+    return {'start': start,
+            'end': end,
+            'resolution': span / pixels}
+
+
+def bar_hints(source, hints, bar_width):
+    """Return (hints, bar_width) for reading bars of bar_width days from
+    source.
+
+    Bars cannot be decimated like lines, so the resolution hint is left
+    out. Aggregated sources, such as pyramid.PyramidSource, can give
+    sums over wider bars though: if source has bins for the resolution,
+    the hint stays and the bars get at least the width of the bins."""
+    hints = dict(hints)
+    resolution = hints.pop('resolution', None)
+    if resolution and hasattr(source, 'get_bin_width'):
+        bin_width = source.get_bin_width(resolution)
+        if bin_width:
+            hints['resolution'] = resolution
+            bar_width = max(bar_width, bin_width)
+    return hints, bar_width
+
+
+class SeriesSource(object):
+    """Base for timeseries that hand out their events as columns.
+
+    This class documents the series source protocol. A series source has:
+
+    - get_chunks(start=None, end=None, resolution=None): yield Columns
+      objects in ascending date order. Start and end are hints in
+      matplotlib date numbers: a source should at least return the events
+      between them, plus one event on either side. Resolution is a hint
+      in days, typically the time span of one pixel: a source may return
+      fewer events as long as a line through them looks the same at that
+      resolution, see decimate(). Sources are free to ignore the hints.
+    - __len__(): the total number of events.
+    - get_extent(): the (first, last) date number, or None when empty.
+    - label, location_id, parameter_id and units attributes, which may
+      be None.
+
+    Subclasses must implement get_chunks. The other methods here work on
+    top of it, but subclasses can often do better. Because get_events()
+    is implemented as well, a series source can be used wherever an old
+    style timeseries is expected.
+    """
+    chunksize = CHUNKSIZE
+    label = None
+    location_id = None
+    parameter_id = None
+    units = None
+
+    def get_chunks(self, start=None, end=None, resolution=None):
+        raise NotImplementedError
+
+    def get_columns(self, start=None, end=None, resolution=None):
+        """Return all (hinted) events as one Columns object."""
+        return Columns.concatenate(self.get_chunks(
+                start=start, end=end, resolution=resolution))
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.get_chunks())
+
+    def get_extent(self):
+        first = None
+        last = None
+        for chunk in self.get_chunks():
+            if len(chunk):
+                if first is None:
+                    first = chunk.dates[0]
+                last = chunk.dates[-1]
+        if first is None:
+            return None
+        return first, last
+
+    def get_events(self, dates=None):
+        """Yield events like old style timeseries do.
+
+        Dates can be a list of datetimes to restrict the events to."""
+        if dates is not None:
+            dates = date2num(dates)
+        for chunk in self.get_chunks():
+            if dates is not None:
+                chunk = chunk.take(numpy.in1d(chunk.dates, dates))
+            comments = chunk.comments
+            if comments is None:
+                comments = [None] * len(chunk)
+            for date, value, flag, comment in zip(
+                num2date(chunk.dates), chunk.values.tolist(),
+                chunk.flags.tolist(), comments):
+                if value != value:
+                    value = None
+                yield date, (value, flag, comment)
+
+
+class EventsSource(SeriesSource):
+    """Series source for an old style timeseries with get_events().
+
+    The events are collected in chunks of chunksize events. The range
+    hints are applied to the chunks, but the timeseries is always read
+    from the start."""
+
+    def __init__(self, timeseries, chunksize=None, label=None):
+        self.timeseries = timeseries
+        if chunksize is not None:
+            self.chunksize = chunksize
+        self.label = label
+        self.location_id = getattr(timeseries, 'location_id', None)
+        self.parameter_id = getattr(timeseries, 'parameter_id', None)
+        self.units = getattr(timeseries, 'units', None)
+
+    def _read_chunks(self):
+        dates = []
+        values = []
+        flags = []
+        comments = []
+        for timestamp, (value, flag, comment) in (
+            self.timeseries.get_events()):
+            dates.append(timestamp)
+            values.append(value)
+            flags.append(flag or 0)
+            comments.append(comment)
+            if len(dates) == self.chunksize:
+                yield Columns(date2num(dates), values, flags, comments)
+                dates = []
+                values = []
+                flags = []
+                comments = []
+        if dates:
+            yield Columns(date2num(dates), values, flags, comments)
+
+    def get_chunks(self, start=None, end=None, resolution=None):
+        for chunk in clip_chunks(self._read_chunks(), start, end):
+            yield decimate(chunk, resolution) if resolution else chunk
+
+
+class ArraySource(SeriesSource):
+    """Series source for arrays that are already in memory.
+
+    Dates can be given as anything to_datenums accepts, tz is passed on
+    to it. They are sorted if they are not in ascending order already."""
+
+    def __init__(self, dates, values, flags=None, comments=None,
+                 label=None, location_id=None, parameter_id=None,
+                 units=None, chunksize=None, tz=None):
+        columns = Columns(to_datenums(dates, tz=tz), values, flags, comments)
+        if len(columns) and (numpy.diff(columns.dates) < 0).any():
+            columns = columns.take(
+                numpy.argsort(columns.dates, kind='mergesort'))
+        self.columns = columns
+        self.label = label
+        self.location_id = location_id
+        self.parameter_id = parameter_id
+        self.units = units
+        if chunksize is not None:
+            self.chunksize = chunksize
+
+    def __len__(self):
+        return len(self.columns)
+
+    def get_extent(self):
+        if not len(self.columns):
+            return None
+        return self.columns.dates[0], self.columns.dates[-1]
+
+    def get_chunks(self, start=None, end=None, resolution=None):
+        dates = self.columns.dates
+        lo = 0
+        hi = len(dates)
+        if start is not None:
+            lo = max(numpy.searchsorted(dates, start, side='left') - 1, 0)
+        if end is not None:
+            hi = min(numpy.searchsorted(dates, end, side='right') + 1, hi)
+        for i in range(lo, hi, self.chunksize):
+            chunk = self.columns.take(slice(i, min(i + self.chunksize, hi)))
+            yield decimate(chunk, resolution) if resolution else chunk
+
+
+class CsvSource(SeriesSource):
+    """Series source for a csv file.
+
+    Reads the layout that DateGridGraph.timeseries_csv writes (a label
+    row, a 'datetime,value,flag,comment' header row and the events), as
+    well as plain 'datetime,value' files with an optional header row.
+    If the file contains more than one timeseries, label selects the one
+    to read; by default the first one is used.
+
+    The file is parsed in blocks of blocksize bytes, see read_csv_chunks
+    for the other arguments.
+    """
+
+    def __init__(self, filename, label=None, comments=False, mmap=False,
+                 blocksize=None):
+        self.filename = filename
+        self.label = label
+        self.comments = comments
+        self.mmap = mmap
+        self.blocksize = blocksize or CSV_BLOCKSIZE
+
+    def _read_chunks(self):
+        selected = None
+        for number, label, chunk in read_csv_chunks(
+            self.filename, comments=self.comments, mmap=self.mmap,
+            blocksize=self.blocksize):
+            if selected is None and self.label in (None, label):
+                selected = number
+            if number == selected:
+                yield chunk
+            elif selected is not None:
+                return
+
+    def get_chunks(self, start=None, end=None, resolution=None):
+        for chunk in clip_chunks(self._read_chunks(), start, end):
+            yield decimate(chunk, resolution) if resolution else chunk
+
+
+CSV_BLOCKSIZE = 16 * 1024 * 1024
+CSV_HEADER = numpy.frombuffer(b'datetime,', dtype=numpy.uint8)
+CSV_NUMBER_WIDTH = 32
+NEWLINE, CARRIAGE_RETURN, SPACE, QUOTE, COMMA = 10, 13, 32, 34, 44
+
+
+def read_csv(filename, comments=False, mmap=False, blocksize=CSV_BLOCKSIZE):
+    """Return a list of ArraySources, one for every timeseries in a csv
+    file in the layout that DateGridGraph.timeseries_csv writes, or in a
+    plain 'datetime,value' layout.
+
+    See read_csv_chunks for the arguments.
+    """
+    numbers = []
+    labels = []
+    chunks = []
+    for number, label, chunk in read_csv_chunks(
+        filename, comments=comments, mmap=mmap, blocksize=blocksize):
+        if not labels or number != numbers[-1]:
+            labels.append(label)
+            chunks.append([])
+            numbers.append(number)
+        chunks[-1].append(chunk)
+    sources = []
+    for label, series_chunks in zip(labels, chunks):
+        columns = Columns.concatenate(series_chunks)
+        sources.append(ArraySource(columns.dates,
+                                   columns.values,
+                                   columns.flags,
+                                   columns.comments,
+                                   label=label))
+    return sources
+
+
+def read_csv_chunks(filename, comments=False, mmap=False,
+                    blocksize=CSV_BLOCKSIZE):
+    """Yield (number, label, Columns) for the events in a csv file.
+
+    Number counts the timeseries in the file, so that timeseries with
+    the same label can be told apart.
+
+    The file is read in blocks of about blocksize bytes that end at a line
+    end. Within a block, the fields are located by searching the positions
+    of all commas and line ends at once, and the dates, values and flags
+    of all lines are parsed as arrays. Lines with dates that can not be
+    parsed, such as headers of plain csv files, are skipped.
+
+    The comment column is only read when comments is True, as it is the
+    only one that needs per line work. With mmap=True, the file is memory
+    mapped instead of read.
+    """
+    if mmap:
+        data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+    else:
+        data = numpy.fromfile(filename, dtype=numpy.uint8)
+    number = 0
+    label = None
+    pos = 0
+    while pos < len(data):
+        stop = min(pos + blocksize, len(data))
+        block = numpy.asarray(data[pos:stop])
+        if stop < len(data):
+            newlines = numpy.flatnonzero(block == NEWLINE)
+            if not len(newlines):
+                # No line end in this block, use a larger one.
+                blocksize *= 2
+                continue
+            block = block[:newlines[-1] + 1]
+        pos += len(block)
+        for number, label, columns in _read_csv_block(
+            block, number, label, comments):
+            if len(columns):
+                yield number, label, columns
+
+
+def _read_csv_block(block, number, label, comments):
+    """Yield (number, label, Columns) for the lines in block, which
+    starts with events of timeseries number, labelled label."""
+    ends = numpy.flatnonzero(block == NEWLINE)
+    if not len(ends) or ends[-1] != len(block) - 1:
+        ends = numpy.append(ends, len(block))
+    starts = numpy.append(0, ends[:-1] + 1)
+    ends = ends - (ends > starts) * (
+        block[numpy.maximum(ends - 1, 0)] == CARRIAGE_RETURN)
+    filled = ends > starts
+    starts = starts[filled]
+    ends = ends[filled]
+
+    # Positions of the first three commas of every line.
+    commas = numpy.append(numpy.flatnonzero(block == COMMA), len(block))
+    first = numpy.searchsorted(commas, starts)
+    fields = []
+    for i in range(3):
+        index = numpy.minimum(first + i, len(commas) - 1)
+        fields.append(numpy.where(commas[index] < ends, commas[index], ends))
+
+    # Label rows have one field, which is quoted if it contains commas.
+    # Dates do not start with a quote.
+    is_label = (fields[0] == ends) | (block[starts] == QUOTE)
+    is_header = numpy.ones(len(starts), dtype=bool)
+    for i, character in enumerate(CSV_HEADER):
+        is_header &= block[numpy.minimum(starts + i, len(block) - 1)] == (
+            character)
+    is_header &= ends - starts >= len(CSV_HEADER)
+    events = ~(is_label | is_header)
+
+    dates = numpy.empty(len(starts))
+    dates.fill(numpy.nan)
+    dates[events] = _csv_dates(block, starts[events], fields[0][events])
+    # Rows without a date are left out, rather than breaking the order.
+    events &= ~numpy.isnan(dates)
+    values = _csv_numbers(block, fields[0][events] + 1, fields[1][events])
+    flags = _csv_numbers(block, numpy.minimum(fields[1][events] + 1, ends[
+                events]), fields[2][events])
+    flags[numpy.isnan(flags)] = 0
+    event_comments = None
+    if comments:
+        event_comments = [
+            _csv_field(block[start:end])
+            for start, end in zip(numpy.minimum(fields[2][events] + 1,
+                                                ends[events]),
+                                  ends[events])]
+    columns = Columns(dates[events], values, flags, event_comments)
+
+    # Split the events at the label rows.
+    labels = numpy.flatnonzero(is_label)
+    splits = numpy.searchsorted(numpy.flatnonzero(events), labels)
+    bounds = numpy.append(numpy.append(0, splits), len(columns))
+    names = [label] + [_csv_field(block[starts[i]:ends[i]]) for i in labels]
+    for i, (name, lo, hi) in enumerate(zip(names, bounds[:-1], bounds[1:])):
+        yield number + i, name, columns.take(slice(lo, hi))
+
+
+def _csv_dates(block, starts, ends):
+    """Return date numbers for the dates in the fields of block between
+    starts and ends.
+
+    Fields of the same width are parsed at once like parse_dates does,
+    the fields that are not in the format of the first go through
+    parse_dates. Empty fields and fields that are not dates (a header
+    row of a plain csv file, for example) are nan."""
+    result = numpy.empty(len(starts))
+    result.fill(numpy.nan)
+    widths = ends - starts
+    for width in numpy.unique(widths):
+        if not width:
+            continue
+        selection = numpy.flatnonzero(widths == width)
+        characters = block[starts[selection, numpy.newaxis] +
+                           numpy.arange(width)]
+        sample = characters[0].tostring()
+        match = ISO8601_REGEX.match(sample)
+        if match:
+            parsed, ok = _parse_block(characters, sample, match)
+            result[selection[ok]] = to_datenums(parsed[ok])
+            selection = selection[~ok]
+            characters = characters[~ok]
+        if len(selection):
+            strings = characters.view('S%d' % width).ravel()
+            result[selection] = to_datenums(
+                parse_dates(strings, invalid='nat'))
+    return result
+
+
+def _csv_numbers(block, starts, ends):
+    """Return floats for the numbers in the fields of block between
+    starts and ends, nan for empty fields.
+
+    The fields are copied into a space separated text, which numpy
+    parses as one list of numbers."""
+    result = numpy.empty(len(starts))
+    result.fill(numpy.nan)
+    widths = ends - starts
+    short = (widths > 0) & (widths <= CSV_NUMBER_WIDTH)
+    if short.any():
+        width = widths[short].max()
+        positions = numpy.arange(width + 1)
+        characters = block[numpy.minimum(
+                starts[short, numpy.newaxis] + positions, len(block) - 1)]
+        characters[positions >= widths[short, numpy.newaxis]] = SPACE
+        numbers = numpy.fromstring(characters.tostring(), sep=' ')
+        if len(numbers) == short.sum():
+            result[short] = numbers
+            widths[short] = 0
+    # Long fields, and fields that do not contain exactly one number.
+    for i in numpy.flatnonzero(widths > 0):
+        try:
+            result[i] = float(block[starts[i]:ends[i]].tostring())
+        except ValueError:
+            pass
+    return result
+
+
+def _csv_field(characters):
+    """Return string for a single csv field, removing the quotes."""
+    field = characters.tostring()
+    if field.startswith('"') and field.endswith('"'):
+        field = field[1:-1].replace('""', '"')
+    return field
+
+
+def as_source(timeseries):
+    """Return a series source for an old or new style timeseries, or for
+    a (dates, values) tuple of arrays."""
+    if hasattr(timeseries, 'get_chunks'):
+        return timeseries
+    if isinstance(timeseries, tuple):
+        return ArraySource(*timeseries)
+    return EventsSource(timeseries)
+
+
 class DateGridGraph(NensGraph):
     """
     Standard graph with a grid and dates on the x-axis.
@@ -258,12 +1664,17 @@ class DateGridGraph(NensGraph):
     _every_ component is needed to calculate the exact location in
     pixels. So if you wanna stack something, you need to recalculate
     all coordinates of components.
+
+    Optional start_date and end_date kwargs set the period of the graph.
+    They are passed as hints to series sources, so that only the events
+    needed for that period at this width are read.
     """
     MARGIN_TOP = 10
     MARGIN_BOTTOM = 25
     MARGIN_LEFT = 104
     MARGIN_RIGHT = 54
 
+    @styled
     def __init__(self, **kwargs):
         super(DateGridGraph, self).__init__(**kwargs)
 
@@ -280,6 +1691,9 @@ class DateGridGraph(NensGraph):
 
         self.axes = self.figure.add_subplot(111)
         self.axes.grid(True)
+        self.legend_obj = None
+        self.legend_key = None
+        self.legend_entries = None
 
         major_locator = LessTicksAutoDateLocator()
         self.axes.xaxis.set_major_locator(major_locator)
@@ -297,6 +1711,15 @@ class DateGridGraph(NensGraph):
         # (label, timeseries)
         self.stored_timeseries = []
 
+        self.start_date = kwargs.get('start_date')
+        self.end_date = kwargs.get('end_date')
+        if self.start_date and self.end_date:
+            self.axes.set_xlim(to_datenums((self.start_date, self.end_date)))
+
+    def source_hints(self):
+        """Return the range and resolution hints for series sources."""
+        return source_hints(self.start_date, self.end_date, self.width)
+
     def graph_width(self):
         """
         Return the current width in pixels.
@@ -319,8 +1742,10 @@ class DateGridGraph(NensGraph):
             self.MARGIN_BOTTOM + self.margin_bottom_extra)
         return max(height, 1)
 
+    @styled
     def legend(self, handles=None, labels=None, legend_location=0,
-               remove_duplicates=False, reversed_legend_items=[]):
+               remove_duplicates=False, reversed_legend_items=None,
+               max_items=None, separate=False):
         """
         Add a legend to a graph.
 
@@ -338,27 +1763,39 @@ class DateGridGraph(NensGraph):
 
         reversed_legend_items can be used to reverse the order of
         those items. The items are listed by index.
+
+        Remove_duplicates removes items with the same label (keeping the
+        last one), and max_items caps the number of items, see
+        legend_items. Calling legend again with the same arguments
+        returns the legend made the first time.
+
+        With separate=True no legend is drawn in the graph, so the graph
+        keeps all of its space. The legend items are returned as a list
+        of legend_entry dicts instead, for the client, and stored for
+        separate_legend, which makes a graph of just the legend.
         """
 
         if not handles or not labels:
             handles, labels = self.axes.get_legend_handles_labels()
 
-        if reversed_legend_items:
-            handle_labels = [(handles[i], labels[i]) for i in reversed_legend_items]
-            handle_labels.reverse()
-            for index, (handle, label) in enumerate(handle_labels):
-                target_index = reversed_legend_items[index]
-                handles[target_index] = handle
-                labels[target_index] = label
-
-        # Remove duplicates: sometimes multiple items have the
-        # same label, we want them removed.
-        if remove_duplicates:
-            labels_copy = list(labels)
-            for index, label in enumerate(labels_copy):
-                while labels.count(label) > 1:
-                    labels.pop(index)
-                    handles.pop(index)
+        key = (tuple(id(handle) for handle in handles), tuple(labels),
+               legend_location, remove_duplicates,
+               tuple(reversed_legend_items or ()), max_items, separate)
+        if key == self.legend_key:
+            if separate:
+                return self.legend_entries
+            if self.legend_obj is not None:
+                return self.legend_obj
+        self.legend_key = key
+
+        handles, labels = legend_items(
+            handles, labels, remove_duplicates=remove_duplicates,
+            reversed_items=reversed_legend_items, max_items=max_items)
+
+        if separate:
+            self.legend_entries = [legend_entry(handle, label)
+                                   for handle, label in zip(handles, labels)]
+            return self.legend_entries
 
         if handles and labels:
             nitems = len(handles)
@@ -367,10 +1804,8 @@ class DateGridGraph(NensGraph):
                 legend_lines = nitems
             else:
                 ncol = min(nitems, 2)
-                # What comes next is an educated guess on the amount of
-                # characters that can be used without collisions in the legend.
-                ntrunc = int((self.width / ncol - 24) / 10)
-                labels = [l[0:ntrunc] for l in labels]
+                labels = self.truncate_labels(labels, ncol,
+                                              width=self.graph_width())
                 legend_lines = int(math.ceil(float(nitems) / ncol))
 
             if legend_location in [3, 4, 8]:
@@ -404,28 +1839,42 @@ class DateGridGraph(NensGraph):
                 borderaxespad=0.,
                 fancybox=True,
                 shadow=True,)
+        return self.legend_obj
+
+    def separate_legend(self, **kwargs):
+        """Return a LegendGraph for the items of legend(separate=True),
+        as wide as this graph and in the same style. Kwargs are passed
+        to LegendGraph."""
+        kwargs.setdefault('width', self.width)
+        kwargs.setdefault('fontsize', self.fontsize)
+        kwargs.setdefault('dpi', self.dpi)
+        return LegendGraph(self.legend_entries or [], **kwargs)
 
     def line_from_single_ts(self, single_ts, graph_item,
                             default_color=None, flags=False):
         """
         Draw line(s) from a single timeseries.
 
+        Single_ts can be an old style timeseries, a series source or a
+        (dates, values) tuple of arrays, see as_source.
+
         Color is a matplotlib color, i.e. 'blue', 'black'
 
         Graph_item can contain an attribute 'layout'.
         Return number of items added to the graph.
         """
         result = 0
-        dates, values, flag_dates, flag_values = dates_values(single_ts)
-        if not values:
+        source = as_source(single_ts)
+        columns = source.get_columns(**self.source_hints())
+        events = columns.valid()
+        if not len(events):
             return result
 
         layout = graph_item.layout_dict()
 
-        label = layout.get('label', '%s - %s (%s)' % (
-                single_ts.location_id, single_ts.parameter_id,
-                single_ts.units))
-        self.stored_timeseries.append((label, single_ts))
+        label = layout.get('label', source.label or '%s - %s (%s)' % (
+                source.location_id, source.parameter_id, source.units))
+        self.stored_timeseries.append((label, source))
 
         marker_style = layout.get('line-style', '-')
         style = {
@@ -435,11 +1884,13 @@ class DateGridGraph(NensGraph):
             }
 
         # Line
-        result += 1 if self.axes.plot(dates, values, marker_style, **style) else 0
+        result += 1 if self.axes.plot(
+            events.dates, events.values, marker_style, **style) else 0
         # Flags: style is not customizable.
         if flags:
+            flagged = events.flagged()
             result += 1 if self.axes.plot(
-                flag_dates, flag_values, "o-", color='red',
+                flagged.dates, flagged.flags, "o-", color='red',
                 label=label + ' flags') else 0
 
         return result
@@ -463,6 +1914,9 @@ class DateGridGraph(NensGraph):
         """
         Draw vertical line.
 
+        Value is anything to_datenums accepts, usually an iso8601
+        string. Unparseable values give a line at the current time.
+
         Return number of items added to the graph
         """
         style = {
@@ -473,49 +1927,61 @@ class DateGridGraph(NensGraph):
         if 'label' in layout:
             style['label'] = layout['label']
         try:
-            dt = iso8601.parse_date(value)
-        except iso8601.ParseError:
-            dt = datetime.datetime.now()
-        return 1 if self.axes.axvline(dt, **style) else 0
+            datenum = to_datenums(value)
+        except ValueError:
+            datenum = to_datenums(datetime.now())
+        return 1 if self.axes.axvline(datenum, **style) else 0
 
     def bar_from_single_ts(self, single_ts, graph_item, bar_width,
                            default_color=None, bottom_ts=None):
         """
         Draw bars.
 
+        Single_ts and bottom_ts can be old style timeseries, series
+        sources or (dates, values) tuples of arrays, see as_source.
+
         Graph_item can contain an attribute 'layout'.
 
         Bottom_ts and single_ts MUST have the same timestamps. This
         can be accomplished by: single_ts = single_ts + bottom_ts * 0
         bottom_ts = bottom_ts + single_ts * 0
 
-        bar_width in days
+        bar_width in days, or a timedelta or numpy timedelta64
 
         Return number of items added to the graph.
         """
-        dates, values, flag_dates, flag_values = dates_values(single_ts)
-
-        bottom = None
-        if bottom_ts:
-            bottom = dates_values(bottom_ts, request_dates=dates)
+        source = as_source(single_ts)
+        hints, bar_width = bar_hints(source, self.source_hints(),
+                                     to_days(bar_width))
+        events = source.get_columns(**hints).valid()
 
-        if not values:
+        if not len(events):
             return
 
+        bottom = None
+        if bottom_ts is not None:
+            bottom_events = as_source(bottom_ts).get_columns(**hints).valid()
+            index = numpy.searchsorted(bottom_events.dates, events.dates)
+            index = numpy.minimum(index, max(len(bottom_events) - 1, 0))
+            bottom = numpy.zeros(len(events))
+            if len(bottom_events):
+                found = bottom_events.dates[index] == events.dates
+                bottom[found] = bottom_events.values[index[found]]
+
         layout = graph_item.layout_dict()
 
-        label = layout.get('label', '%s - %s (%s)' % (
-            single_ts.location_id, single_ts.parameter_id, single_ts.units))
-        self.stored_timeseries.append((label, single_ts))
+        label = layout.get('label', source.label or '%s - %s (%s)' % (
+            source.location_id, source.parameter_id, source.units))
+        self.stored_timeseries.append((label, source))
 
         style = {'color': layout.get('color', default_color),
                  'edgecolor': layout.get('color-outside', 'grey'),
                  'label': label,
-                 'width': bar_width}
-        if bottom:
-            style['bottom'] = bottom[1]  # 'values' of bottom
+                 'width': to_days(bar_width)}
+        if bottom is not None:
+            style['bottom'] = bottom
 
-        return 1 if self.axes.bar(dates, values, **style) else 0
+        return 1 if self.axes.bar(events.dates, events.values, **style) else 0
 
     def set_margins(self):
         """
@@ -558,8 +2024,9 @@ class DateGridGraph(NensGraph):
         if response is None:
             for label, ts in self.stored_timeseries:
                 print label
-                print ts.get_events()
+                print list(ts.get_events())
             return
+        import csv
         writer = csv.writer(response)
         for label, ts in self.stored_timeseries:
             writer.writerow([label])
@@ -581,6 +2048,62 @@ class DateGridGraph(NensGraph):
         return result
 
 
+class LegendGraph(NensGraph):
+    """Graph of just a legend, for legends shared by many graphs.
+
+    Entries are legend_entry dicts, see DateGridGraph.legend and
+    separate_legend. The height of the graph follows from the number of
+    rows. Graphs with the same entries, width and style look the same,
+    so their image can be cached by cache_key and rendered once.
+    """
+
+    @styled
+    def __init__(self, entries, ncol=None, **kwargs):
+        self.entries = list(entries)
+        self.ncol = ncol or max(min(len(self.entries), 2), 1)
+        kwargs['height'] = 1
+        super(LegendGraph, self).__init__(**kwargs)
+        self.height = self.legend_height()
+        self.figure.set_size_inches(
+            Converter(dpi=self.dpi).inches_from_pixels(self.width),
+            Converter(dpi=self.dpi).inches_from_pixels(self.height))
+        self.legend_obj = None
+        if self.entries:
+            labels = self.truncate_labels(
+                [entry['label'] for entry in self.entries], self.ncol)
+            self.legend_obj = self.figure.legend(
+                [legend_handle(entry) for entry in self.entries],
+                labels,
+                loc='upper left',
+                bbox_to_anchor=(0., 0., 1., 1.),
+                ncol=self.ncol,
+                borderaxespad=0.,
+                frameon=False)
+
+    def legend_height(self):
+        """Return the height in pixels of the legend, from the legend rc
+        params and the text metrics cache."""
+        from matplotlib.font_manager import FontProperties
+        rc = matplotlib.rcParams
+        prop = FontProperties(size=rc['legend.fontsize'])
+        em = prop.get_size_in_points() * self.dpi / 72
+        rows = int(math.ceil(len(self.entries) / self.ncol))
+        if not rows:
+            return 1
+        row = max(text_extent('lp', prop, self.dpi)[1],
+                  em * rc['legend.handleheight'])
+        return int(math.ceil(em * (2 * rc['legend.borderpad'] +
+                                   (rows - 1) * rc['legend.labelspacing']) +
+                             rows * row))
+
+    def cache_key(self):
+        """Return a key for the image of this legend."""
+        data = json.dumps([self.entries, self.ncol, self.width,
+                           sorted(self.rc.items())], sort_keys=True,
+                          default=repr)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+
+
 class Converter(object):
     """Conversion methods for graphs."""
     def __init__(self, dpi=72):
@@ -736,7 +2259,8 @@ class MultilineAutoDateFormatter(AutoDateFormatter):
             self.ticks = ticks
             self.min = ticks[0]
             self.max = ticks[-1]
-            self.step = ticks[1] - ticks[0]
+            # A single tick gets the labels of a period without others.
+            self.step = ticks[1] - ticks[0] if len(ticks) > 1 else 0
             self.span = ticks[-1] - ticks[0]
             self.mid = ticks[int((len(ticks) - 1) / 2)]
 
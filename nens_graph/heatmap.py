@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Heatmaps of many timeseries: a row per series, a column per time bin.
+
+The series are resampled onto a regular time grid of about one bin per
+pixel and drawn as a single image, so drawing takes time according to
+the size of the graph, not to the number or length of the series.
+"""
+from __future__ import division
+
+import numpy
+
+from nens_graph.common import LessTicksAutoDateLocator
+from nens_graph.common import MultilineAutoDateFormatter
+from nens_graph.common import NensGraph
+from nens_graph.common import as_source
+from nens_graph.common import styled
+from nens_graph.common import to_datenums
+from nens_graph.common import truncate_text
+
+import matplotlib
+from matplotlib import cm
+from matplotlib.font_manager import FontProperties
+from matplotlib.ticker import FixedLocator
+from matplotlib.ticker import NullLocator
+
+
+def time_grid(start, end, bins):
+    """Return bins + 1 regularly spaced edges from start to end."""
+    return numpy.linspace(start, end, bins + 1)
+
+
+def bin_sums(dates, values, edges):
+    """Return (sums, counts) of the values per bin between edges.
+
+    Dates are ascending date numbers, values an array with dates along
+    the last axis (one series, or one row per series). Nan values don't
+    count. Sums and counts of consecutive stretches of a series can be
+    added up."""
+    values = numpy.asarray(values, dtype=float)
+    nbins = len(edges) - 1
+    shape = values.shape[:-1] + (nbins,)
+    sums = numpy.zeros(shape)
+    counts = numpy.zeros(shape, dtype=int)
+    bins = numpy.searchsorted(edges, dates, side='right') - 1
+    inside = (bins >= 0) & (bins < nbins)
+    bins = bins[inside]
+    values = values[..., inside]
+    if not len(bins):
+        return sums, counts
+    starts = numpy.flatnonzero(numpy.diff(bins)) + 1
+    starts = numpy.append(0, starts)
+    valid = ~numpy.isnan(values)
+    sums[..., bins[starts]] = numpy.add.reduceat(
+        numpy.where(valid, values, 0), starts, axis=-1)
+    counts[..., bins[starts]] = numpy.add.reduceat(
+        valid.astype(int), starts, axis=-1)
+    return sums, counts
+
+
+def resample(dates, values, edges):
+    """Return the mean of values per bin between edges, see bin_sums.
+    Bins without values are nan."""
+    sums, counts = bin_sums(dates, values, edges)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(counts, sums / counts, numpy.nan)
+
+
+class HeatmapGraph(NensGraph):
+    """Graph of many timeseries as one image, with dates along x.
+
+    Constructor arguments, besides those of NensGraph:
+    - start_date, end_date: the period of the graph
+    - cmap (optional, default: cm.viridis if available, else cm.jet)
+    - vmin, vmax (optional): the values at the ends of the colormap
+
+    Add the series with add_array (a 2-D array of series sharing their
+    dates) or add_series (any series sources), and a color bar with
+    colorbar. Rows are labelled with the series labels when they fit.
+    """
+    MARGIN_TOP = 10
+    MARGIN_BOTTOM = 35
+    MARGIN_LEFT = 104
+    MARGIN_RIGHT = 80
+    COLORBAR_WIDTH = 12
+
+    @styled
+    def __init__(self, start_date, end_date, cmap=None, vmin=None,
+                 vmax=None, **kwargs):
+        super(HeatmapGraph, self).__init__(**kwargs)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.cmap = cmap or getattr(cm, 'viridis', cm.jet)
+        self.vmin = vmin
+        self.vmax = vmax
+        self.rows = []
+        self.labels = []
+        self.image = None
+        self.colorbar_obj = None
+
+        self.axes = self.figure.add_axes((
+            self.MARGIN_LEFT / self.width,
+            self.MARGIN_BOTTOM / self.height,
+            self.axes_width() / self.width,
+            (self.height - self.MARGIN_TOP - self.MARGIN_BOTTOM) /
+            self.height))
+        self.start, self.end = to_datenums((start_date, end_date))
+        self.axes.set_xlim(self.start, self.end)
+
+        major_locator = LessTicksAutoDateLocator()
+        self.axes.xaxis.set_major_locator(major_locator)
+        major_formatter = MultilineAutoDateFormatter(
+            major_locator, self.axes)
+        self.axes.xaxis.set_major_formatter(major_formatter)
+
+    def axes_width(self):
+        """Return the width of the axes in pixels."""
+        return max(self.width - self.MARGIN_LEFT - self.MARGIN_RIGHT, 1)
+
+    def edges(self):
+        """Return the edges of the time bins, one bin per pixel."""
+        return time_grid(self.start, self.end, int(self.axes_width()))
+
+    def add_array(self, dates, values, labels=None):
+        """Add rows for series that share their dates: values is a 2-D
+        array with a row per series. Dates can be date numbers or
+        datetime64 values, in ascending order."""
+        values = numpy.atleast_2d(values)
+        self.rows.append(resample(to_datenums(dates), values, self.edges()))
+        if labels is None:
+            labels = [''] * len(values)
+        self.labels.extend(labels)
+
+    def add_series(self, timeseries):
+        """Add a row per timeseries (anything common.as_source accepts).
+
+        Cells are the means of all events in their bins: the series are
+        read in full, chunk by chunk, as the events that sources hand out
+        at a coarser resolution (extremes, or pyramid bins that don't
+        line up with the cells) don't average to the mean."""
+        edges = self.edges()
+        rows = []
+        for single_ts in timeseries:
+            source = as_source(single_ts)
+            sums = numpy.zeros(len(edges) - 1)
+            counts = numpy.zeros(len(edges) - 1, dtype=int)
+            for chunk in source.get_chunks(start=self.start, end=self.end):
+                chunk_sums, chunk_counts = bin_sums(
+                    chunk.dates, chunk.values, edges)
+                sums += chunk_sums
+                counts += chunk_counts
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                rows.append(numpy.where(counts, sums / counts, numpy.nan))
+            self.labels.append(source.label or '')
+        if rows:
+            self.rows.append(numpy.vstack(rows))
+
+    def values(self):
+        """Return the resampled values, a row per series."""
+        if not self.rows:
+            return numpy.empty((0, len(self.edges()) - 1))
+        return numpy.vstack(self.rows)
+
+    @styled
+    def draw_image(self):
+        """Draw the rows as one image, nan values transparent."""
+        values = numpy.ma.masked_invalid(self.values())
+        self.image = self.axes.imshow(
+            values,
+            cmap=self.cmap,
+            vmin=self.vmin,
+            vmax=self.vmax,
+            aspect='auto',
+            interpolation='nearest',
+            origin='upper',
+            extent=(self.start, self.end, len(values), 0))
+        self.axes.set_xlim(self.start, self.end)
+        self.axes.set_ylim(len(values), 0)
+        self.set_row_labels()
+        return self.image
+
+    def set_row_labels(self):
+        """Label the rows with the series labels if there is room for
+        them, else leave the y axis without ticks."""
+        rows = len(self.labels)
+        line_height = 1.2 * self.fontsize * self.dpi / 72
+        height = self.height - self.MARGIN_TOP - self.MARGIN_BOTTOM
+        if rows and rows * line_height <= height:
+            prop = FontProperties(
+                size=matplotlib.rcParams['ytick.labelsize'])
+            width = self.MARGIN_LEFT - 10
+            self.axes.yaxis.set_major_locator(
+                FixedLocator(numpy.arange(rows) + 0.5))
+            self.axes.set_yticklabels(
+                [truncate_text(label, width, prop, self.dpi)
+                 for label in self.labels])
+        else:
+            self.axes.yaxis.set_major_locator(NullLocator())
+
+    @styled
+    def colorbar(self, label=None):
+        """Add a color bar in the right margin. Call after draw_image."""
+        if self.image is None:
+            self.draw_image()
+        position = self.axes.get_position()
+        cax = self.figure.add_axes((
+            position.x1 + 10 / self.width,
+            position.y0,
+            self.COLORBAR_WIDTH / self.width,
+            position.height))
+        self.colorbar_obj = self.figure.colorbar(self.image, cax=cax)
+        if label:
+            self.colorbar_obj.set_label(label)
+        return self.colorbar_obj
+
+    def prepare_draw(self):
+        if self.image is None:
+            self.draw_image()
+        super(HeatmapGraph, self).prepare_draw()
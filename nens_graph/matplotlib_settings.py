@@ -1,4 +1,7 @@
 # Import this ONCE from a settings.py
+#
+# This changes matplotlib's global defaults, for figures that are not
+# nens_graph graphs. Graphs apply their own style, see common.styled.
 
 import matplotlib
 
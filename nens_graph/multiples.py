@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Small multiples: many timeseries in panels of one figure.
+
+The panels share the x axis. Its ticks and tick labels are computed
+once, for the first panel, and only the bottom row shows them. The
+layout is plain pixel arithmetic, so the whole grid is drawn once.
+"""
+from __future__ import division
+import math
+
+import numpy
+
+from nens_graph.common import LessTicksAutoDateLocator
+from nens_graph.common import MultilineAutoDateFormatter
+from nens_graph.common import NensGraph
+from nens_graph.common import as_source
+from nens_graph.common import source_hints
+from nens_graph.common import styled
+from nens_graph.common import to_datenums
+
+from matplotlib.ticker import FixedFormatter
+from matplotlib.ticker import FixedLocator
+from matplotlib.ticker import MaxNLocator
+
+
+class SmallMultiplesGraph(NensGraph):
+    """Graph of count panels with a shared date x axis.
+
+    Constructor arguments, besides those of NensGraph:
+    - count: the number of panels
+    - ncols (optional, default: 1): the number of panels per row
+    - start_date, end_date (optional): the period of the x axis
+    - sharey (optional, default: False): share the y axis as well
+    - titles (optional): a title per panel, drawn inside its top left
+      corner
+
+    The panels are in the panels attribute, row by row. Series can be
+    added per panel with add_series, or all at once as columns with
+    add_columns. With sharey, only the first column shows y tick labels
+    and the columns are SPACING apart, otherwise MARGIN_LEFT apart.
+    """
+    MARGIN_TOP = 10
+    MARGIN_BOTTOM = 35
+    MARGIN_LEFT = 50
+    MARGIN_RIGHT = 10
+    SPACING = 5
+
+    @styled
+    def __init__(self, count, ncols=1, start_date=None, end_date=None,
+                 sharey=False, titles=None, **kwargs):
+        super(SmallMultiplesGraph, self).__init__(**kwargs)
+        self.count = count
+        self.ncols = max(min(ncols, count), 1)
+        self.nrows = int(math.ceil(count / self.ncols))
+        self.start_date = start_date
+        self.end_date = end_date
+        self.column_spacing = self.SPACING if sharey else self.MARGIN_LEFT
+        self.xlabel = None
+        self.ylabel = None
+
+        self.panels = []
+        for index in range(count):
+            first = self.panels[0] if self.panels else None
+            axes = self.figure.add_axes(
+                self.panel_position(index),
+                sharex=first,
+                sharey=first if sharey else None)
+            axes.grid(True, linestyle='-', color='lightgrey')
+            axes.set_axisbelow(True)
+            if not sharey or first is None:
+                axes.yaxis.set_major_locator(
+                    MaxNLocator(nbins=self.ybins(), prune='both'))
+            if index < count - self.ncols:
+                axes.tick_params(labelbottom=False)
+            if sharey and index % self.ncols:
+                axes.tick_params(labelleft=False)
+            if titles is not None and index < len(titles):
+                axes.text(0.01, 0.97, titles[index],
+                          transform=axes.transAxes,
+                          horizontalalignment='left',
+                          verticalalignment='top')
+            self.panels.append(axes)
+        self.axes = self.panels[0]
+
+        if self.start_date and self.end_date:
+            self.axes.set_xlim(to_datenums((self.start_date, self.end_date)))
+
+    def panel_size(self):
+        """Return (width, height) of a panel in pixels."""
+        width = (self.width - self.MARGIN_LEFT - self.MARGIN_RIGHT -
+                 (self.ncols - 1) * self.column_spacing) / self.ncols
+        height = (self.height - self.MARGIN_TOP - self.MARGIN_BOTTOM -
+                  (self.nrows - 1) * self.SPACING) / self.nrows
+        return max(width, 1), max(height, 1)
+
+    def panel_position(self, index):
+        """Return the position (x, y, width, height) of panel index in
+        figure coordinates."""
+        row, col = divmod(index, self.ncols)
+        width, height = self.panel_size()
+        x = self.MARGIN_LEFT + col * (width + self.column_spacing)
+        y = self.height - self.MARGIN_TOP - height - row * (
+            height + self.SPACING)
+        return (x / self.width, y / self.height,
+                width / self.width, height / self.height)
+
+    def ybins(self):
+        """Return the number of y tick intervals that fit in a panel,
+        about one per two lines of text."""
+        height = self.panel_size()[1]
+        return max(int(height / (2 * self.fontsize * self.dpi / 72)), 2)
+
+    def source_hints(self):
+        """Return the range and resolution hints for series sources,
+        about one event per pixel of a panel."""
+        return source_hints(self.start_date, self.end_date,
+                            self.panel_size()[0])
+
+    @styled
+    def add_series(self, index, timeseries, **kwargs):
+        """Plot timeseries (anything common.as_source accepts) as a line
+        in panel index. Kwargs are passed to matplotlib's plot method."""
+        source = as_source(timeseries)
+        events = source.get_columns(**self.source_hints()).valid()
+        kwargs.setdefault('label', source.label)
+        return self.panels[index].plot(events.dates, events.values,
+                                       **kwargs)
+
+    @styled
+    def add_columns(self, dates, values, **kwargs):
+        """Plot a line per panel: dates is one array of date numbers (or
+        datetime64s), values a 2-D array with a row per panel. Nan values
+        are left out of the lines. Kwargs are passed to matplotlib's plot
+        method."""
+        dates = to_datenums(dates)
+        values = numpy.atleast_2d(values)
+        return [axes.plot(dates, row, **kwargs)
+                for axes, row in zip(self.panels, values)]
+
+    @styled
+    def set_xlabel(self, xlabel):
+        """Set a label under the bottom row of panels."""
+        self.xlabel = self.figure.text(
+            (self.MARGIN_LEFT + self.width - self.MARGIN_RIGHT) /
+            (2 * self.width),
+            2 / self.height, xlabel,
+            horizontalalignment='center',
+            verticalalignment='bottom')
+
+    @styled
+    def set_ylabel(self, ylabel):
+        """Set a label left of all panels."""
+        self.ylabel = self.figure.text(
+            2 / self.width,
+            (self.MARGIN_BOTTOM + self.height - self.MARGIN_TOP) /
+            (2 * self.height),
+            ylabel,
+            rotation=90,
+            horizontalalignment='left',
+            verticalalignment='center')
+
+    def set_ticks(self):
+        """Compute the date ticks and tick labels once and fix them for
+        all panels, which share the x axis."""
+        locator = LessTicksAutoDateLocator()
+        self.axes.xaxis.set_major_locator(locator)
+        formatter = MultilineAutoDateFormatter(locator, self.axes)
+        low, high = sorted(self.axes.get_xlim())
+        locs = [loc for loc in locator() if low <= loc <= high]
+        if locs:
+            formatter.tickinfo = formatter.Tickinfo(locs)
+        labels = [formatter(loc, i) for i, loc in enumerate(locs)]
+        self.axes.xaxis.set_major_locator(FixedLocator(locs))
+        self.axes.xaxis.set_major_formatter(FixedFormatter(labels))
+
+    def prepare_draw(self):
+        self.set_ticks()
+        super(SmallMultiplesGraph, self).prepare_draw()
@@ -1,19 +1,17 @@
 """
 """
 import datetime
-import matplotlib
 import numpy
 
-from django.http import HttpResponse
-
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.dates import date2num
-from matplotlib.figure import Figure
 from matplotlib.ticker import MaxNLocator
 from matplotlib.ticker import ScalarFormatter
 
 from nens_graph.common import MultilineAutoDateFormatter
 from nens_graph.common import LessTicksAutoDateLocator
+from nens_graph.common import graph_rc
+from nens_graph.common import styled
+from nens_graph.common import to_datenums
+from nens_graph.scales import restrict_to_month
 
 FONT_SIZE = 10.0
 LEGEND_WIDTH = 200
@@ -30,8 +28,6 @@ PARAMS = {
     'ytick.labelsize': FONT_SIZE,
     }
 
-matplotlib.rcParams.update(PARAMS)
-
 
 def _inches_from_pixels(pixels):
     """Return size in inches for matplotlib's benefit"""
@@ -46,8 +42,12 @@ class OldGraph(object):
     - horizontal axis = dates
     - vertical axis = user defined
     - outputs httpresponse for png
+
+    The style (PARAMS) is applied per graph, like NensGraph does.
     """
+    rc = graph_rc(fontsize=FONT_SIZE, dpi=SCREEN_DPI)
 
+    @styled
     def __init__(self,
                  start_date, end_date,
                  width=None, height=None,
@@ -58,6 +58,8 @@ class OldGraph(object):
         self.end_date = end_date
         self.today = today
 
+        from matplotlib.figure import Figure
+
         self.figure = Figure()
         if width is None or not width:
             width = 380.0
@@ -81,6 +83,10 @@ class OldGraph(object):
         self.legend_on_bottom_height = 0.0
         self.axes = self.figure.add_subplot(111)
         self.axes.grid(True)
+        if self.restrict_to_month:
+            # Dates are folded onto the month, the scale sets the limits,
+            # locators and formatters. See scales.break_cycles for lines.
+            restrict_to_month(self.axes, self.restrict_to_month)
 
         # Fixup_axes in init, so axes can be customised (for example set_ylim).
         self.fixup_axes()
@@ -90,7 +96,9 @@ class OldGraph(object):
 
     def add_today(self):
         # Show line for today.
-        self.axes.axvline(self.today, color='orange', lw=1, ls='--')
+        self.today_line = self.axes.axvline(to_datenums(self.today),
+                                            color='orange', lw=1, ls='--')
+        return self.today_line
 
     def set_ylim_margin(self, top=0.1, bottom=0.0):
         """Adjust y-margin of axes.
@@ -131,11 +139,13 @@ class OldGraph(object):
                 self.axes.set_ylim(view_low, view_high)
         return None
 
+    @styled
     def suptitle(self, title):
         self.figure.suptitle(title,
                              x=self.left_label_width,
                              horizontalalignment='left')
 
+    @styled
     def set_xlabel(self, xlabel):
         self.axes.set_xlabel(xlabel)
         self.x_label_height = BOTTOM_LINE_HEIGHT / self.height
@@ -182,6 +192,7 @@ class OldGraph(object):
         there is no legend displayed"""
         self.legend_width = LEGEND_WIDTH / self.width
 
+    @styled
     def legend(self, handles=None, labels=None, ncol=1):
         """
         Displays legend. Default is right side, but if the width is
@@ -229,6 +240,7 @@ class OldGraph(object):
         self.ax2 = self.axes.twinx()
         self.fixup_axes(second=True)
 
+    @styled
     def http_png(self):
         """Output plot to png. Also calculates size of plot and put 'now'
         line."""
@@ -250,13 +262,16 @@ class OldGraph(object):
         # Set date range
         # Somehow, the range cannot be set in __init__
         if not self.restrict_to_month:
-            self.axes.set_xlim(date2num((self.start_date, self.end_date)))
+            self.axes.set_xlim(to_datenums((self.start_date, self.end_date)))
             try:
                 self.set_ylim_margin(top=0.1, bottom=0.0)
             except:
                 pass
 
-        canvas = FigureCanvas(self.figure)
+        from django.http import HttpResponse
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        canvas = FigureCanvasAgg(self.figure)
         response = HttpResponse(content_type='image/png')
         canvas.print_png(response)
         return response
@@ -1,19 +1,178 @@
 from __future__ import division
 from datetime import datetime
 from logging import getLogger
+import re
+
+import numpy
+
+from nens_graph.common import Columns
 from nens_graph.common import NensGraph
+from nens_graph.common import styled
 from nens_graph.common import MultilineAutoDateFormatter
 from nens_graph.common import LessTicksAutoDateLocator
-
+from nens_graph.common import SeriesSource
+from nens_graph.common import as_source
+from nens_graph.common import source_hints
+from nens_graph.common import to_datenums
+from nens_graph.scales import break_cycles
+from nens_graph.scales import cycle_bounds
+from nens_graph.scales import restrict_to_month
+
+from dateutil.parser import parse as parse_datetime
 from matplotlib import cm
 from matplotlib.dates import date2num
 
 logger = getLogger(__name__)
 
+# Time units of CF conventions, in days.
+TIME_UNITS = {
+    'seconds': 1 / 86400,
+    'second': 1 / 86400,
+    'secs': 1 / 86400,
+    's': 1 / 86400,
+    'minutes': 1 / 1440,
+    'minute': 1 / 1440,
+    'mins': 1 / 1440,
+    'hours': 1 / 24,
+    'hour': 1 / 24,
+    'hrs': 1 / 24,
+    'h': 1 / 24,
+    'days': 1,
+    'day': 1,
+    'd': 1,
+    }
+TIME_UNITS_REGEX = re.compile(r'^\s*(\w+)\s+since\s+(.+?)\s*$')
+
+
+def parse_time_units(units):
+    """Return (origin, factor) for CF time units like 'hours since
+    1970-01-01 00:00:00': the date number of the origin and the number of
+    days per unit. Times without a timezone are UTC."""
+    match = TIME_UNITS_REGEX.match(units)
+    if not match or match.group(1).lower() not in TIME_UNITS:
+        raise ValueError('Unsupported time units: %r' % units)
+    return (date2num(parse_datetime(match.group(2))),
+            TIME_UNITS[match.group(1).lower()])
+
+
+def bisect_variable(variable, value, lo, hi, side='left'):
+    """Like numpy.searchsorted on variable[lo:hi], but reads single
+    elements only, about log2(hi - lo) of them."""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        element = variable[mid]
+        if element < value or (side == 'right' and element == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class OpendapSource(SeriesSource):
+    """Series source for a variable in a NetCDF dataset.
+
+    Dataset is a netCDF4.Dataset (or any object with a netCDF4 like
+    variables dict), or a local filename or OPeNDAP url, which is opened
+    with netCDF4. Variable is the name of a variable with time as its
+    first dimension; the name of the time variable is time_variable, its
+    values must be ascending and have CF time units. If the variable has
+    a station dimension as well, station is either the index along it, or
+    a name that is looked up in station_variable.
+
+    Nothing but the metadata is read up front. The range hints are
+    applied by binary search on the time variable, element by element,
+    and the resolution hint sets the stride, so only the events that end
+    up in the graph are read. Striding assumes regular time steps.
+    """
+
+    def __init__(self, dataset, variable, station=None,
+                 time_variable='time', station_variable=None, label=None):
+        if isinstance(dataset, basestring):
+            import netCDF4
+            dataset = netCDF4.Dataset(dataset)
+        self.dataset = dataset
+        self.variable = dataset.variables[variable]
+        self.time = dataset.variables[time_variable]
+        self.origin, self.factor = parse_time_units(self.time.units)
+        self.count = self.time.shape[0]
+
+        if isinstance(station, basestring):
+            station = self.station_index(
+                dataset.variables[station_variable], station)
+        self.station = station
+
+        self.parameter_id = variable
+        self.units = getattr(self.variable, 'units', None)
+        if station_variable is not None and station is not None:
+            self.location_id = self.station_names(
+                dataset.variables[station_variable])[station]
+        self.label = label or ' '.join(
+            str(part) for part in (
+                getattr(self.variable, 'long_name', variable),
+                self.location_id) if part is not None)
+
+    @staticmethod
+    def station_names(station_variable):
+        """Return the station names as an array of strings."""
+        names = numpy.asarray(station_variable[:])
+        if names.dtype.kind == 'S' and names.ndim == 2:
+            # Character arrays have a row of single characters per name.
+            names = names.view('S%d' % names.shape[1]).ravel()
+        return numpy.char.strip(names.astype(str))
+
+    def station_index(self, station_variable, name):
+        indices = numpy.flatnonzero(
+            self.station_names(station_variable) == name)
+        if not len(indices):
+            raise KeyError('Station %r not found.' % name)
+        return indices[0]
+
+    def to_times(self, datenum):
+        return (datenum - self.origin) / self.factor
+
+    def to_datenums(self, times):
+        return self.origin + numpy.asarray(times, dtype=float) * self.factor
+
+    def __len__(self):
+        return self.count
+
+    def get_extent(self):
+        if not self.count:
+            return None
+        return (self.to_datenums(self.time[0]),
+                self.to_datenums(self.time[self.count - 1]))
+
+    def get_chunks(self, start=None, end=None, resolution=None):
+        lo = 0
+        hi = self.count
+        if start is not None:
+            lo = max(bisect_variable(self.time, self.to_times(start),
+                                     lo, hi) - 1, 0)
+        if end is not None:
+            hi = min(bisect_variable(self.time, self.to_times(end),
+                                     lo, hi, side='right') + 1, hi)
+        stride = 1
+        if resolution and hi - lo > 1:
+            step = (self.to_datenums(self.time[hi - 1]) -
+                    self.to_datenums(self.time[lo])) / (hi - lo - 1)
+            if step > 0:
+                stride = max(int(resolution / step), 1)
+
+        for i in range(lo, hi, stride * self.chunksize):
+            index = slice(i, min(i + stride * self.chunksize, hi), stride)
+            if self.station is None:
+                values = self.variable[index]
+            else:
+                values = self.variable[index, self.station]
+            values = numpy.ma.asarray(values).astype(float)
+            yield Columns(self.to_datenums(self.time[index]),
+                          numpy.ma.filled(values, numpy.nan))
+
 
 class OpendapGraph(NensGraph):
     """Class for matplotlib river graphs."""
 
+    @styled
     def __init__(self,
                  start_km=None,
                  end_km=None,
@@ -33,6 +192,8 @@ class OpendapGraph(NensGraph):
         # Layout of the axes in the figure
         self.axes = self.figure.add_axes([0, 0, 1, 1])
         self.axes.grid(True, linestyle='-', color='lightgrey')
+        if self.restrict_to_month:
+            restrict_to_month(self.axes, self.restrict_to_month)
         self.suptitle_obj = None
         self.legend_obj = None
         self.ylabel = None
@@ -48,38 +209,69 @@ class OpendapGraph(NensGraph):
         self.colormap = cm.cool
         self.patch_zorder = 10
 
+    @styled
     def suptitle(self, title):
         self.suptitle_obj = self.figure.suptitle(title,
                              horizontalalignment='left',
                              verticalalignment='top')
 
+    @styled
     def set_xlabel(self, xlabel):
         self.xlabel = self.axes.set_xlabel(xlabel,
                                            size='large',
                                            horizontalalignment='right',
                                            verticalalignment='center')
 
+    @styled
     def set_ylabel(self, ylabel):
         self.ylabel = self.axes.set_ylabel(ylabel,
                                            size='large',
                                            horizontalalignment='right',
                                            verticalalignment='center')
 
+    def source_hints(self):
+        """Return the range and resolution hints for series sources."""
+        span = None
+        if self.restrict_to_month:
+            # The dates are folded, the x axis spans one month.
+            span = numpy.diff(cycle_bounds(self.restrict_to_month))[0]
+        return source_hints(self.start_date, self.end_date, self.width,
+                            span=span)
+
+    def line_from_source(self, timeseries, **kwargs):
+        """Plot a line for timeseries, typically an OpendapSource.
+
+        Only the events between start_date and end_date are read, at
+        about one per pixel. Kwargs are passed to matplotlib's plot
+        method; the label defaults to the label of the source.
+
+        With restrict_to_month, all years are drawn on top of each
+        other."""
+        source = as_source(timeseries)
+        events = source.get_columns(**self.source_hints()).valid()
+        kwargs.setdefault('label', source.label)
+        dates, values = events.dates, events.values
+        if self.restrict_to_month:
+            dates, values = break_cycles(dates, values,
+                                         month=self.restrict_to_month)
+        return self.axes.plot(dates, values, **kwargs)
+
     def add_today(self):
         # Show line for today.
-        self.axes.axvline(self.today, color='orange', lw=1, ls='--')
+        self.today_line = self.axes.axvline(to_datenums(self.today),
+                                            color='orange', lw=1, ls='--')
+        return self.today_line
 
+    @styled
     def legend(self, handles=None, labels=None):
         handles, labels = self.axes.get_legend_handles_labels()
 
         if handles and labels:
             nitems = len(handles)
             ncol = int((nitems - 1) / 3) + 1
-            # What comes next is an educated guess on the amount of
-            # characters that can be used without collisions in the legend.
-            ntrunc = int((self.width / ncol - 24) / 8)
-
-            labels = [l[0:ntrunc] for l in labels]
+            self.legend_labels_full = labels
+            self.legend_ncol = ncol
+            labels = self.truncate_labels(labels, ncol)
             return self.axes.legend(handles,
                                     labels,
                                     bbox_to_anchor=(0., 0., 1., 0.),
@@ -92,21 +284,43 @@ class OpendapGraph(NensGraph):
         else:
             return None
 
-    def png_response(self):
-
-        if not self.restrict_to_month:
-            self.axes.set_xlim(date2num((self.start_date, self.end_date)))
-
-        # Do final tweaks after data has been added to the axes
-        ylim_old = self.axes.get_ylim()
-        ylim_new = (ylim_old[0],
-                    ylim_old[1] + 0.15 * (ylim_old[1] - ylim_old[0]))
-        self.axes.set_ylim(ylim_new)
-
-        self.axes.set_autoscaley_on(False)
-        self.legend_obj = self.legend()
-
-        return super(OpendapGraph, self).png_response()
+    def prepare_draw(self):
+        # Finish the graph once, it may be rendered more than once.
+        if not self.finished:
+            if not self.restrict_to_month:
+                self.axes.set_xlim(
+                    to_datenums((self.start_date, self.end_date)))
+                major_locator = LessTicksAutoDateLocator()
+                major_formatter = MultilineAutoDateFormatter(
+                    major_locator, self.axes)
+                self.axes.xaxis.set_major_locator(major_locator)
+                self.axes.xaxis.set_major_formatter(major_formatter)
+
+            # Do final tweaks after data has been added to the axes
+            ylim_old = self.axes.get_ylim()
+            ylim_new = (ylim_old[0],
+                        ylim_old[1] + 0.15 * (ylim_old[1] - ylim_old[0]))
+            self.axes.set_ylim(ylim_new)
+
+            self.axes.set_autoscaley_on(False)
+            self.legend_obj = self.legend()
+
+        super(OpendapGraph, self).prepare_draw()
+
+    def layout_signature(self):
+        """The layout depends on the sizes of the labels and tick labels,
+        and on the legend."""
+        legend = None
+        if self.legend_obj:
+            legend = (tuple(self.legend_labels_full), self.legend_ncol)
+        return self.layout_key(
+            self.text_signature(self.xlabel),
+            self.text_signature(self.ylabel),
+            self.suptitle_obj is not None,
+            self.tick_signature(self.axes.xaxis),
+            self.tick_signature(self.axes.yaxis),
+            legend,
+            self.restrict_to_month)
 
     def on_draw(self):
         """ Do last minute tweaks before actual rendering.
@@ -114,13 +328,6 @@ class OpendapGraph(NensGraph):
         This method is triggered by the draw_event, which is configured in the
         NensGraph class."""
 
-        if not self.restrict_to_month:
-            major_locator = LessTicksAutoDateLocator()
-            major_formatter = MultilineAutoDateFormatter(
-                major_locator, self.axes)
-            self.axes.xaxis.set_major_locator(major_locator)
-            self.axes.xaxis.set_major_formatter(major_formatter)
-
         margin_in_pixels = 5
         xmargin = self.get_width_from_pixels(margin_in_pixels)
         ymargin = self.get_height_from_pixels(margin_in_pixels)
@@ -164,22 +371,16 @@ class OpendapGraph(NensGraph):
         axes_width = 1 - axes_x - xmargin
         axes_height = 1 - axes_y - ymargin
 
-        # adjust the layout accordingly
+        # adjust the layout accordingly, and align the legend with the new
+        # axes layout
         logger.debug(self.suptitle_obj)
-        if self.suptitle_obj:
-            self.suptitle_obj.set_position(
-                (axes_x + xsuptitlepadding,
-                 1 - ymargin - ysuptitlepadding))
-        self.axes.set_position((axes_x,
-                                axes_y,
-                                axes_width,
-                                axes_height))
-
-        # align the legend with the new axes layout
+        layout = {'axes': (axes_x, axes_y, axes_width, axes_height),
+                  'suptitle': (axes_x + xsuptitlepadding,
+                               1 - ymargin - ysuptitlepadding)}
         if self.legend_obj:
-            self.legend_obj.set_bbox_to_anchor(
-                (axes_x,
-                 ymargin,
-                 axes_width,
-                 legendheight),
-                transform=self.figure.transFigure)
+            layout['legend'] = (axes_x, ymargin, axes_width, legendheight)
+            layout['legend_labels'] = self.truncate_labels(
+                self.legend_labels_full, self.legend_ncol,
+                axes_width * self.width)
+        self.apply_layout(layout)
+        self.store_layout(layout)
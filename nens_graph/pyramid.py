@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Pre-aggregated timeseries for graphs of long periods.
+
+A Pyramid keeps the minimum, maximum, sum and count of a timeseries per
+bin, for a number of bin widths (levels), in local files. When a graph
+asks for a period at a certain resolution, a PyramidSource hands out the
+bins of the coarsest level that is still finer than the resolution, so
+a ten year graph reads a few thousand bins instead of all events.
+"""
+from __future__ import division
+
+import os
+import tempfile
+
+import numpy
+
+from nens_graph.common import Columns
+from nens_graph.common import SeriesSource
+from nens_graph.common import as_source
+
+HOUR = 1 / 24
+
+# Bin widths in days. Bins are aligned to multiples of their width.
+LEVELS = (HOUR, 6 * HOUR, 1, 7, 30, 365)
+
+BINS_DTYPE = numpy.dtype([('date', '<f8'),
+                          ('min', '<f8'),
+                          ('max', '<f8'),
+                          ('sum', '<f8'),
+                          ('count', '<u4')])
+
+
+def aggregate(columns, width):
+    """Return bins of width days for columns, which must be sorted."""
+    columns = columns.valid()
+    if not len(columns):
+        return numpy.empty(0, dtype=BINS_DTYPE)
+    bins = numpy.floor(columns.dates / width)
+    starts = numpy.flatnonzero(numpy.diff(bins)) + 1
+    starts = numpy.append(0, starts)
+    result = numpy.empty(len(starts), dtype=BINS_DTYPE)
+    result['date'] = bins[starts] * width
+    result['min'] = numpy.minimum.reduceat(columns.values, starts)
+    result['max'] = numpy.maximum.reduceat(columns.values, starts)
+    result['sum'] = numpy.add.reduceat(columns.values, starts)
+    result['count'] = numpy.diff(numpy.append(starts, len(columns)))
+    return result
+
+
+def combine(bins):
+    """Return bins with the bins for the same date combined."""
+    if not len(bins):
+        return bins
+    bins = bins[numpy.argsort(bins['date'], kind='mergesort')]
+    starts = numpy.flatnonzero(numpy.diff(bins['date'])) + 1
+    starts = numpy.append(0, starts)
+    if len(starts) == len(bins):
+        return bins
+    result = numpy.empty(len(starts), dtype=BINS_DTYPE)
+    result['date'] = bins['date'][starts]
+    result['min'] = numpy.minimum.reduceat(bins['min'], starts)
+    result['max'] = numpy.maximum.reduceat(bins['max'], starts)
+    result['sum'] = numpy.add.reduceat(bins['sum'], starts)
+    result['count'] = numpy.add.reduceat(bins['count'], starts)
+    return result
+
+
+class Pyramid(object):
+    """Aggregated bins of one timeseries, stored in directory.
+
+    There is one file per level, with the bins as records of BINS_DTYPE
+    in date order. The files are memory mapped for reading, and replaced
+    as a whole when the pyramid is updated, so readers in other processes
+    never see half written files.
+    """
+
+    def __init__(self, directory, levels=LEVELS):
+        self.directory = directory
+        self.levels = sorted(levels)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filename(self, width):
+        return os.path.join(self.directory,
+                            '%d.bin' % int(round(width * 86400)))
+
+    def get_bins(self, width):
+        """Return the stored bins of a level, memory mapped."""
+        filename = self.filename(width)
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            return numpy.empty(0, dtype=BINS_DTYPE)
+        return numpy.memmap(filename, dtype=BINS_DTYPE, mode='r')
+
+    def get_level(self, resolution):
+        """Return the width of the coarsest level that is not coarser
+        than resolution, or None if there is no such level."""
+        widths = [w for w in self.levels if resolution and w <= resolution]
+        if not widths:
+            return None
+        return widths[-1]
+
+    def clear(self):
+        for width in self.levels:
+            if os.path.exists(self.filename(width)):
+                os.remove(self.filename(width))
+
+    def build(self, timeseries):
+        """Build the pyramid from scratch for timeseries."""
+        self.clear()
+        self.update(timeseries)
+
+    def update(self, timeseries):
+        """Add the events of timeseries to the pyramid.
+
+        Only the new events are aggregated. Their bins are combined with
+        the stored bins from the first bin they touch onwards, which is
+        cheap when the new events are newer than the stored ones. Events
+        that are already in the pyramid must not be added again."""
+        new_bins = dict((width, []) for width in self.levels)
+        for chunk in as_source(timeseries).get_chunks():
+            for width in self.levels:
+                new_bins[width].append(aggregate(chunk, width))
+        for width in self.levels:
+            new = combine(numpy.concatenate(new_bins[width]))
+            if len(new):
+                self._merge(width, new)
+
+    def _merge(self, width, new):
+        stored = self.get_bins(width)
+        index = numpy.searchsorted(stored['date'], new['date'][0])
+        tail = combine(numpy.concatenate((stored[index:], new)))
+        handle, temp_filename = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as bins_file:
+                bins_file.write(numpy.asarray(stored[:index]).tostring())
+                bins_file.write(tail.tostring())
+            os.chmod(temp_filename, 0o644)
+            os.rename(temp_filename, self.filename(width))
+        except:
+            os.remove(temp_filename)
+            raise
+
+    def source(self, raw=None, statistic='minmax'):
+        return PyramidSource(self, raw=raw, statistic=statistic)
+
+
+class PyramidSource(SeriesSource):
+    """Series source that picks a pyramid level for the resolution hint.
+
+    Without a resolution hint, or when the resolution is finer than the
+    finest level, the events of raw are used (or the finest level if raw
+    is None). Otherwise, the bins of the coarsest level that is not
+    coarser than the resolution are returned as events, according to
+    statistic:
+
+    - 'minmax': the minimum and maximum of each bin, at a quarter and
+      three quarters of the bin, so lines look like lines through all
+      events
+    - 'mean', 'min' or 'max': one event in the middle of each bin
+    - 'sum': one event at the start of each bin, for bars of the bin
+      width, see get_bin_width
+    """
+
+    def __init__(self, pyramid, raw=None, statistic='minmax'):
+        self.pyramid = pyramid
+        self.raw = raw
+        self.statistic = statistic
+        if raw is not None:
+            self.raw = as_source(raw)
+            self.label = self.raw.label
+            self.location_id = self.raw.location_id
+            self.parameter_id = self.raw.parameter_id
+            self.units = self.raw.units
+
+    def get_bin_width(self, resolution=None):
+        """Return the bin width for events at resolution, or None when
+        raw events are used."""
+        width = self.pyramid.get_level(resolution)
+        if width is None and self.raw is None:
+            width = self.pyramid.levels[0]
+        return width
+
+    def __len__(self):
+        if self.raw is not None:
+            return len(self.raw)
+        return int(self.pyramid.get_bins(self.pyramid.levels[0])[
+                'count'].sum())
+
+    def get_extent(self):
+        if self.raw is not None:
+            return self.raw.get_extent()
+        bins = self.pyramid.get_bins(self.pyramid.levels[0])
+        if not len(bins):
+            return None
+        return bins['date'][0], bins['date'][-1] + self.pyramid.levels[0]
+
+    def get_chunks(self, start=None, end=None, resolution=None):
+        width = self.get_bin_width(resolution)
+        if width is None:
+            for chunk in self.raw.get_chunks(start=start, end=end,
+                                             resolution=resolution):
+                yield chunk
+            return
+        bins = self.pyramid.get_bins(width)
+        lo = 0
+        hi = len(bins)
+        if start is not None:
+            lo = max(numpy.searchsorted(bins['date'], start - width) - 1, 0)
+        if end is not None:
+            hi = min(numpy.searchsorted(bins['date'], end, side='right') + 1,
+                     hi)
+        for i in range(lo, hi, self.chunksize):
+            yield self._columns(
+                numpy.asarray(bins[i:min(i + self.chunksize, hi)]), width)
+
+    def _columns(self, bins, width):
+        if self.statistic == 'minmax':
+            dates = numpy.column_stack((bins['date'] + width / 4,
+                                        bins['date'] + 3 * width / 4))
+            values = numpy.column_stack((bins['min'], bins['max']))
+            return Columns(dates.ravel(), values.ravel())
+        if self.statistic == 'sum':
+            return Columns(bins['date'], bins['sum'])
+        if self.statistic == 'mean':
+            values = bins['sum'] / bins['count']
+        else:
+            values = bins[self.statistic]
+        return Columns(bins['date'] + width / 2, values)
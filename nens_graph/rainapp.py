@@ -7,13 +7,24 @@ from matplotlib.transforms import Bbox
 from nens_graph.common import MultilineAutoDateFormatter
 from nens_graph.common import LessTicksAutoDateLocator
 from nens_graph.common import NensGraph
+from nens_graph.common import styled
+from nens_graph.common import as_source
+from nens_graph.common import bar_hints
+from nens_graph.common import source_hints
+from nens_graph.common import to_datenums
+from nens_graph.common import to_days
 
 
 class RainappGraph(NensGraph):
     """Specialized graph class for the rainapp
 
-    It is specifically intended for bar charts presently."""
+    It is specifically intended for bar charts presently.
 
+    Dates can be datetimes, numpy datetime64 arrays or date numbers.
+    Datetime64 values are taken as local times in the tz kwarg, and
+    converted to UTC for the whole array at once."""
+
+    @styled
     def __init__(self,
                  start_date_ams,
                  end_date_ams,
@@ -36,39 +47,86 @@ class RainappGraph(NensGraph):
 
     def add_today(self):
         # Show line for today.
-        self.axes.axvline(self.today, color='orange', lw=1, ls='--')
+        self.today_line = None
+        if self.today is not None:
+            self.today_line = self.axes.axvline(self.to_datenums(self.today),
+                                                color='orange', lw=1, ls='--')
+        return self.today_line
 
-    def get_bar_width(self, delta_t):
-        """ Return width in data space for given timedelta."""
-        date1 = datetime.now()
-        date2 = date1 + delta_t
-        width = date2num(date2) - date2num(date1)
-        return width
+    def to_datenums(self, dates):
+        """Return date numbers for dates, using the tz of this graph."""
+        return to_datenums(dates, tz=self.tz)
 
+    def get_bar_width(self, delta_t):
+        """ Return width in data space for given timedelta.
+
+        Delta_t can be a timedelta, a numpy timedelta64 (or an array of
+        those) or a relativedelta."""
+        try:
+            return to_days(delta_t)
+        except TypeError:
+            # Relativedeltas only have a width relative to some date.
+            date1 = datetime.now()
+            date2 = date1 + delta_t
+            width = date2num(date2) - date2num(date1)
+            return width
+
+    def add_bars(self, dates, values, delta_t, **kwargs):
+        """Add bars of width delta_t at dates.
+
+        Kwargs are passed to matplotlib's bar method."""
+        return self.axes.bar(self.to_datenums(dates),
+                             values,
+                             width=self.get_bar_width(delta_t),
+                             **kwargs)
+
+    def source_hints(self):
+        """Return the range and resolution hints for series sources."""
+        start, end = self.to_datenums((self.start_date_ams,
+                                       self.end_date_ams))
+        return source_hints(start, end, self.width)
+
+    def bar_from_source(self, timeseries, delta_t, **kwargs):
+        """Add bars of width delta_t for the events of timeseries.
+
+        Timeseries is anything common.as_source accepts. Only the events
+        in the period of the graph are read. For aggregated sources, such
+        as a pyramid.PyramidSource with statistic 'sum', the source picks
+        the coarsest level that still fits the width of the graph and the
+        bars get the width of that level."""
+        source = as_source(timeseries)
+        hints, width = bar_hints(source, self.source_hints(),
+                                 self.get_bar_width(delta_t))
+        events = source.get_columns(**hints).valid()
+        return self.axes.bar(events.dates, events.values, width=width,
+                             **kwargs)
+
+    @styled
     def suptitle(self, title):
         self.suptitle_obj = self.figure.suptitle(
             title,
             horizontalalignment='left')
 
+    @styled
     def set_xlabel(self, xlabel):
         """Store the label object for later use as well"""
         self.xlabel = self.axes.set_xlabel(xlabel)
 
+    @styled
     def set_ylabel(self, ylabel):
         """Store the label object for later use as well"""
         self.ylabel = self.axes.set_ylabel(ylabel, size='x-large')
 
+    @styled
     def legend(self, handles=None, labels=None):
         handles, labels = self.axes.get_legend_handles_labels()
 
         if handles and labels:
             nitems = len(handles)
             ncol = min(nitems, 3)
-            # What comes next is an educated guess on the amount of
-            # characters that can be used without collisions in the legend.
-            ntrunc = int((self.width / ncol - 24) / 10)
-
-            labels = [l[0:ntrunc] for l in labels]
+            self.legend_labels_full = labels
+            self.legend_ncol = ncol
+            labels = self.truncate_labels(labels, ncol)
             self.legend_obj = self.axes.legend(handles,
                               labels,
                               bbox_to_anchor=(0., 0., 1., 0.),
@@ -78,6 +136,19 @@ class RainappGraph(NensGraph):
                               # mode="expand",
                               borderaxespad=0.)
 
+    def layout_signature(self):
+        """The layout depends on the sizes of the labels and tick labels,
+        and on the legend."""
+        legend = None
+        if self.legend_obj:
+            legend = (tuple(self.legend_labels_full), self.legend_ncol)
+        return self.layout_key(
+            self.text_signature(self.ylabel),
+            self.suptitle_obj is not None,
+            self.tick_signature(self.axes.xaxis),
+            self.tick_signature(self.axes.yaxis),
+            legend)
+
     def on_draw(self):
         """ Do last minute tweaks before actual rendering.
 
@@ -115,26 +186,20 @@ class RainappGraph(NensGraph):
         axes_width = 1 - axes_x - xmargin
         axes_height = 1 - axes_y - ymargin
 
-        # adjust the layout accordingly
-        if self.suptitle_obj:
-            self.suptitle_obj.set_position(
-                (axes_x + xsuptitlepadding,
-                 1 - ymargin - ysuptitlepadding))
-        self.axes.set_position((axes_x,
-                                axes_y,
-                                axes_width,
-                                axes_height))
-
-        # align the legend with the new axes layout
+        # adjust the layout accordingly, and align the legend with the new
+        # axes layout
+        layout = {'axes': (axes_x, axes_y, axes_width, axes_height),
+                  'suptitle': (axes_x + xsuptitlepadding,
+                               1 - ymargin - ysuptitlepadding)}
         if self.legend_obj:
-            self.legend_obj.set_bbox_to_anchor(
-                (axes_x,
-                 ymargin,
-                 axes_width,
-                 legendheight),
-                transform=self.figure.transFigure)
+            layout['legend'] = (axes_x, ymargin, axes_width, legendheight)
+            layout['legend_labels'] = self.truncate_labels(
+                self.legend_labels_full, self.legend_ncol,
+                axes_width * self.width)
+        self.apply_layout(layout)
+        self.store_layout(layout)
 
-    def png_response(self):
+    def prepare_draw(self):
 
         # try:
         #     self.set_ylim_margin(top=0.1, bottom=0.0)
@@ -156,7 +221,8 @@ class RainappGraph(NensGraph):
         # self.axes.set_ylim(ylim_new)
 
         # self.legend()
-        self.axes.set_xlim(date2num((self.start_date_ams, self.end_date_ams)))
+        self.axes.set_xlim(
+            self.to_datenums((self.start_date_ams, self.end_date_ams)))
 
         # find out about the data extents and set ylim accordingly
         if len(self.axes.patches) > 0:
@@ -169,4 +235,4 @@ class RainappGraph(NensGraph):
 
             self.axes.set_ylim((ymin, ymax))
 
-        return super(RainappGraph, self).png_response()
+        super(RainappGraph, self).prepare_draw()
@@ -1,24 +1,85 @@
 from math import pi
-from random import choice
-from random import seed
-from numpy import arange
+from numpy import argsort
 from numpy import array
+from numpy import asarray
+from numpy import atleast_2d
+from numpy import bincount
+from numpy import column_stack
 from numpy import concatenate
+from numpy import cumsum
+from numpy import diff
+from numpy import empty
+from numpy import inf
+from numpy import isnan
+from numpy import lexsort
+from numpy import maximum
+from numpy import newaxis
+from numpy import percentile
+from numpy import repeat
+from numpy import searchsorted
+from numpy import zeros
 from logging import getLogger
+from nens_graph.common import Columns
 from nens_graph.common import NensGraph
+from nens_graph.common import styled
+from nens_graph.common import decimate
+from nens_graph.common import text_width
 
 from matplotlib import cm
+from matplotlib.colors import BoundaryNorm
+from matplotlib.colors import ListedColormap
 from matplotlib.collections import RegularPolyCollection
 from matplotlib.collections import CircleCollection
+from matplotlib.collections import LineCollection
+from matplotlib.font_manager import FontProperties
 from matplotlib.lines import Line2D
-from matplotlib.text import Text
 
 logger = getLogger(__name__)
 
+# Default colormap of add_threshold_profile: green below the thresholds,
+# red above them.
+THRESHOLD_CMAP = cm.RdYlGn_r
+
+# Marker categories of the bar axes, by category code: label, legend
+# marker, number of sides (0 for circles), rotation and y position.
+MARKER_CATEGORIES = (
+    ('Knelpunten', 'o', 0, 0, 0.1),
+    ('Retentie', 'v', 3, pi, 0.3),
+    ('Dijken / kades', 's', 4, pi / 4, 0.5),
+    ('Groene rivieren / ontrekkingen', '^', 3, 0, 0.7),
+    ('Overig', 'D', 4, 0, 0.9),
+    )
+KNELPUNTEN, RETENTIE, DIJKEN, ONTTREKKINGEN, OVERIG = range(
+    len(MARKER_CATEGORIES))
+
+# Default legend labels of add_scenarios, in Dutch like the other labels:
+# a highlighted scenario without a name (by index), and the median line
+# of an envelope (after the label).
+SCENARIO_LABEL = 'Scenario %d'
+MEDIAN_LABEL = '%s (mediaan)'
+
+
+def km_slice(kms, low=None, high=None, margin=0):
+    """Return the slice of sorted kms between low and high, found by
+    binary search. Margin extends the slice by that many kms on either
+    side."""
+    lo = 0
+    hi = len(kms)
+    if low is not None:
+        lo = max(searchsorted(kms, low, side='left') - margin, 0)
+    if high is not None:
+        hi = min(searchsorted(kms, high, side='right') + margin, hi)
+    return slice(lo, hi)
+
 
 class RiverGraph(NensGraph):
-    """Class for matplotlib river graphs."""
+    """Class for matplotlib river graphs.
+
+    If start_km and/or end_km are given, the graph shows only that
+    stretch of the river. Profiles, markers and places outside it are
+    left out before any artist is created."""
 
+    @styled
     def __init__(self,
                  start_km=None,
                  end_km=None,
@@ -40,6 +101,9 @@ class RiverGraph(NensGraph):
                                           0.49],
                                          ylabel='MHW overschrijding [m]')
         self.axes.grid(True, linestyle='-', color='lightgrey')
+        if start_km is not None and end_km is not None:
+            self.axes.set_xlim(self.km_range())
+            self.axes.set_autoscalex_on(False)
         self.axes.invert_xaxis()
         self.bar_axes = self.figure.add_axes([axes_left,
                                               0.10,
@@ -65,240 +129,372 @@ class RiverGraph(NensGraph):
         self.colormap = cm.cool
         self.patch_zorder = 10
 
-    def png_response(self):
-
-        # Do final tweaks after data has been added to the axes
-        ylim_old = self.axes.get_ylim()
-        ylim_new = (ylim_old[0],
-                    ylim_old[1] + 0.15 * (ylim_old[1] - ylim_old[0]))
-        self.axes.set_ylim(ylim_new)
-        self.bar_axes.set_xlim(self.axes.get_xlim())
-        for l in self.axes.get_xaxis().get_majorticklabels():
-            l.set_visible(False)
-        for l in self.bar_axes.get_yaxis().get_majorticklabels():
-            l.set_horizontalalignment('left')
-            l.set_position((-.08, 0))
-
-        self.axes.set_autoscaley_on(False)
-        self.axes.axhline(0,
-                          color='#030303',
-                          linestyle=':',
-                          linewidth=3,
-                          label='Nullijn')
-
-        # Add fake patches at fake positions
-        seed(0)
-        xlim = self.axes.get_xlim()
-        step = (max(xlim) - min(xlim)) / 40
-        kms = arange(xlim[1] + step, xlim[0] - step, step)
-        iters = 25
-
-        self.add_diamonds([choice(kms) for i in range(iters)])
-        self.add_uptriangles([choice(kms) for i in range(iters)])
-        self.add_squares([choice(kms) for i in range(iters)])
-        self.add_downtriangles([choice(kms) for i in range(iters)])
-        self.add_circles([choice(kms) for i in range(iters)])
-        self.bar_axes.text(0.5, 0.5, 'RANDOM DATA',
-                           horizontalalignment='center',
-                           verticalalignment='center',
-                           transform=self.bar_axes.transAxes,
-                           zorder=100,
-                           size=50,
-                           color='red',
-                           alpha=0.2)
-
-        # Add some test place_names
-        self.add_text((xlim[1] + (xlim[0] - xlim[1]) * 0.2,
-                       xlim[1] + (xlim[0] - xlim[1]) * 0.5,
-                       xlim[1] + (xlim[0] - xlim[1]) * 0.7),
-                      ('Plaats C',
-                       'Plaats B',
-                       'Plaats A'))
-
-        self.legend()
-
-        return super(RiverGraph, self).png_response()
+        # place names, see add_text
+        self.place_kms = []
+        self.place_names = []
+        self.place_padding = 4
+
+    def prepare_draw(self):
+        # Finish the graph once, it may be rendered more than once.
+        if not self.finished:
+            # Do final tweaks after data has been added to the axes
+            ylim_old = self.axes.get_ylim()
+            ylim_new = (ylim_old[0],
+                        ylim_old[1] + 0.15 * (ylim_old[1] - ylim_old[0]))
+            self.axes.set_ylim(ylim_new)
+            self.bar_axes.set_xlim(self.axes.get_xlim())
+            for l in self.axes.get_xaxis().get_majorticklabels():
+                l.set_visible(False)
+            for l in self.bar_axes.get_yaxis().get_majorticklabels():
+                l.set_horizontalalignment('left')
+                l.set_position((-.08, 0))
+
+            self.axes.set_autoscaley_on(False)
+            self.axes.axhline(0,
+                              color='#030303',
+                              linestyle=':',
+                              linewidth=3,
+                              label='Nullijn')
+
+            self.draw_places()
+            self.legend()
+
+        super(RiverGraph, self).prepare_draw()
+
+    def km_range(self):
+        """Return (low, high) km of the stretch of the graph.
+
+        With both start_km and end_km, the stretch lies between them,
+        whatever their order. With only one of them, start_km is the
+        lowest km and end_km the highest km shown: data on the other side
+        of it is left out and the x axis fits the rest. The other bound
+        is None then, as both are without start_km and end_km."""
+        if self.start_km is None or self.end_km is None:
+            return self.start_km, self.end_km
+        return (min(self.start_km, self.end_km),
+                max(self.start_km, self.end_km))
+
+    def km_resolution(self, kms):
+        """Return the km width of a pixel of the axes, for the stretch of
+        the graph or else the span of kms, which must be sorted."""
+        low, high = self.km_range()
+        if low is None or high is None:
+            if not len(kms):
+                return None
+            low = kms[0] if low is None else low
+            high = kms[-1] if high is None else high
+        pixels = self.axes.get_position().width * self.width
+        return (high - low) / pixels
+
+    def add_profile(self, kms, values, **kwargs):
+        """Plot a longitudinal profile of values along kms.
+
+        Only the part on the stretch of the graph (plus one point on
+        either side) is plotted, decimated to the pixel width of the
+        axes, see common.decimate. Nan values break the line. Kwargs are
+        passed to matplotlib's plot method."""
+        profile = self.profile_columns(kms, values)
+        return self.axes.plot(profile.dates, profile.values, **kwargs)
+
+    def profile_columns(self, kms, values):
+        """Return Columns with the sorted, clipped and decimated profile
+        (kms as dates). Nan values are kept as breaks."""
+        kms = asarray(kms, dtype=float)
+        values = asarray(values, dtype=float)
+        if (diff(kms) < 0).any():
+            order = argsort(kms, kind='mergesort')
+            kms = kms[order]
+            values = values[order]
+        index = km_slice(kms, *self.km_range(), margin=1)
+        return decimate(Columns(kms[index], values[index]),
+                        self.km_resolution(kms[index]), gaps=True)
+
+    def add_threshold_profile(self, kms, values, thresholds, colors=None,
+                              cmap=None, linewidth=2, label=None):
+        """Plot a longitudinal profile coloured by exceedance.
+
+        Each segment between two points gets the color of the class its
+        highest value falls in; the classes are bounded by the sorted
+        thresholds. Colors has a color per class (one more than there are
+        thresholds); without colors, the classes are spread over cmap
+        (default THRESHOLD_CMAP). The segments are one LineCollection,
+        coloured through a BoundaryNorm. If label is given, each class
+        gets a legend entry.
+
+        Like add_profile, only the stretch of the graph is plotted.
+        Return the LineCollection. Raise ValueError without thresholds."""
+        thresholds = sorted(thresholds)
+        if not thresholds:
+            raise ValueError('Need at least one threshold.')
+        profile = self.profile_columns(kms, values)
+        boundaries = concatenate(([-inf], thresholds, [inf]))
+        if colors is not None:
+            if len(colors) != len(thresholds) + 1:
+                raise ValueError('Need %d colors for %d thresholds.' %
+                                 (len(thresholds) + 1, len(thresholds)))
+            cmap = ListedColormap(colors)
+        elif cmap is None:
+            cmap = THRESHOLD_CMAP
+        norm = BoundaryNorm(boundaries, cmap.N)
+
+        points = column_stack((profile.dates, profile.values))
+        segments = concatenate((points[:-1, newaxis], points[1:, newaxis]),
+                               axis=1)
+        # Segments that end at a missing value are gaps.
+        highest = maximum(profile.values[:-1], profile.values[1:])
+        filled = ~isnan(highest)
+        collection = LineCollection(segments[filled],
+                                    cmap=cmap,
+                                    norm=norm,
+                                    linewidths=linewidth)
+        collection.set_array(highest[filled])
+        self.axes.add_collection(collection)
+        self.axes.autoscale_view()
+
+        if label is not None:
+            names = (['< %g' % thresholds[0]] +
+                     ['%g - %g' % pair
+                      for pair in zip(thresholds[:-1], thresholds[1:])] +
+                     ['> %g' % thresholds[-1]])
+            for i, name in enumerate(names):
+                # Middle of the class, bounded for the outer classes.
+                low = boundaries[i] if i > 0 else thresholds[0] - 1
+                high = (boundaries[i + 1] if i < len(thresholds)
+                        else thresholds[-1] + 1)
+                line = Line2D((0, 1), (0, 0),
+                              color=cmap(norm((low + high) / 2)),
+                              linewidth=linewidth)
+                self.legend_handles.append(line)
+                self.legend_labels.append('%s %s' % (label, name))
+        return collection
+
+    def add_scenarios(self, kms, values, names=None, highlight=(),
+                      envelope=None, label=None, color='lightgrey',
+                      linewidth=1):
+        """Plot profiles of many scenarios along the same kms.
+
+        Values is a 2D array with a row per scenario and a column per km.
+        All scenarios are drawn as one LineCollection, in color and
+        labelled label. The scenarios with indices in highlight are drawn
+        on top, in colors from self.colormap and twice as wide; they get
+        a legend entry each, named by names if given, else SCENARIO_LABEL
+        with their index.
+
+        If envelope is a (low, high) tuple of percentiles, the scenarios
+        are drawn as a band between those percentiles (computed per km
+        for all scenarios at once) and a line for the median instead. The
+        highlighted scenarios are still drawn as lines.
+
+        Like add_profile, only the stretch of the graph is plotted.
+        Return the LineCollection. Raise ValueError for highlight indices
+        that are not scenarios, or if names has not a name per scenario.
+        """
+        kms = asarray(kms, dtype=float)
+        values = atleast_2d(asarray(values, dtype=float))
+        highlight = list(highlight)
+        if any(not 0 <= i < len(values) for i in highlight):
+            raise ValueError('Highlight indices must be from 0 to %d.' %
+                             (len(values) - 1))
+        if len(set(highlight)) != len(highlight):
+            raise ValueError('Highlight indices must be unique.')
+        if names is not None and len(names) != len(values):
+            raise ValueError('Got %d names for %d scenarios.' %
+                             (len(names), len(values)))
+        if (diff(kms) < 0).any():
+            order = argsort(kms, kind='mergesort')
+            kms = kms[order]
+            values = values[:, order]
+        index = km_slice(kms, *self.km_range(), margin=1)
+        kms = kms[index]
+        values = values[:, index]
+
+        if envelope is None:
+            shown = [i for i in range(len(values)) if i not in highlight]
+        else:
+            shown = []
+            low, median, high = percentile(
+                values, (envelope[0], 50, envelope[1]), axis=0)
+            self.axes.fill_between(kms, low, high,
+                                   color=color,
+                                   linewidth=0,
+                                   label=label)
+            self.axes.plot(kms, median,
+                           color='#030303',
+                           linewidth=linewidth,
+                           label=label and MEDIAN_LABEL % label)
+        shown.extend(highlight)
+
+        segments = empty((len(shown), len(kms), 2))
+        segments[:, :, 0] = kms
+        segments[:, :, 1] = values[shown]
+        colors = [color] * (len(shown) - len(highlight))
+        linewidths = [linewidth] * len(colors)
+        for n, i in enumerate(highlight):
+            highlight_color = self.colormap(
+                (n + 0.5) / len(highlight))
+            colors.append(highlight_color)
+            linewidths.append(2 * linewidth)
+            line = Line2D((0, 1), (0, 0),
+                          color=highlight_color,
+                          linewidth=2 * linewidth)
+            self.legend_handles.append(line)
+            self.legend_labels.append(
+                names[i] if names is not None else SCENARIO_LABEL % i)
+        collection = LineCollection(segments,
+                                    colors=colors,
+                                    linewidths=linewidths,
+                                    label=envelope is None and label or None)
+        self.axes.add_collection(collection)
+        self.axes.autoscale_view()
+        return collection
+
+    def add_markers(self, kms, codes):
+        """Add a layer of markers to bar_axes at specified kms.
+
+        Codes are category codes, indices into MARKER_CATEGORIES, one for
+        each km. The markers of a category are drawn as one collection,
+        at the height and in the colour of that category. The
+        self.legend_handles and self.legend_labels receive an entry for
+        every category in the layer, if they have none yet.
+
+        The markers are sorted by category and km at once, so that the
+        markers of each category on the stretch of the graph are found
+        by binary search. Raise ValueError for codes that are not
+        categories, or if there are not as many codes as kms."""
+        kms = asarray(kms, dtype=float)
+        codes = asarray(codes, dtype=int)
+        if len(codes) != len(kms):
+            raise ValueError('Got %d codes for %d kms.' %
+                             (len(codes), len(kms)))
+        if len(codes) and (codes.min() < 0 or
+                           codes.max() >= len(MARKER_CATEGORIES)):
+            raise ValueError('Marker codes must be from 0 to %d.' %
+                             (len(MARKER_CATEGORIES) - 1))
+        order = lexsort((kms, codes))
+        counts = bincount(codes, minlength=len(MARKER_CATEGORIES))
+        bounds = concatenate(([0], cumsum(counts)))
+        for code, (label, marker, numsides, rotation, ypos) in enumerate(
+            MARKER_CATEGORIES):
+            category_kms = kms[order[bounds[code]:bounds[code + 1]]]
+            category_kms = category_kms[km_slice(category_kms,
+                                                 *self.km_range())]
+            if not len(category_kms):
+                continue
+            offsets = column_stack((category_kms,
+                                    repeat(ypos, len(category_kms))))
+            facecolor = self.colormap(ypos)
+            if numsides:
+                collection = RegularPolyCollection(
+                    numsides=numsides,
+                    rotation=rotation,
+                    sizes=(self.polysize,),
+                    facecolors=facecolor,
+                    offsets=offsets,
+                    transOffset=self.bar_axes.transData,
+                    zorder=self.patch_zorder)
+            else:
+                collection = CircleCollection(
+                    sizes=(self.circlesize,),
+                    facecolors=facecolor,
+                    offsets=offsets,
+                    transOffset=self.bar_axes.transData,
+                    zorder=self.patch_zorder)
+            self.bar_axes.add_collection(collection)
+
+            if label in self.legend_labels:
+                continue
+            line = Line2D((0, 1),
+                          (0, 0),
+                          linestyle='',
+                          marker=marker,
+                          markersize=self.legend_markersize,
+                          markeredgewidth=self.legend_markeredgewidth,
+                          markerfacecolor=facecolor)
+            self.legend_handles.append(line)
+            self.legend_labels.append(label)
 
     def add_diamonds(self, kms):
-        """Add diamonds to bar_axes at specified kms.
-
-        The self.legend_handles_labels receives the patch as well."""
-        ypos = 0.9
-        km_arr = array(kms).reshape(-1, 1)
-        ypos_arr = array([ypos for x in kms]).reshape(-1, 1)
-        offsets = concatenate((km_arr, ypos_arr), axis=1)
-
-        collection = RegularPolyCollection(
-            numsides=4,
-            rotation=0,
-            sizes=(self.polysize,),
-            facecolors=self.colormap(ypos),
-            offsets=offsets,
-            transOffset=self.bar_axes.transData,
-            zorder=self.patch_zorder)
-        self.bar_axes.add_collection(collection)
-
-        line = Line2D((0, 1),
-                      (0, 0),
-                      linestyle='',
-                      marker='D',
-                      markersize=self.legend_markersize,
-                      markeredgewidth=self.legend_markeredgewidth,
-                      markerfacecolor=self.colormap(ypos))
-        label = 'Overig'
-        self.legend_handles.append(line)
-        self.legend_labels.append(label)
+        """Add diamonds ('Overig') to bar_axes at specified kms."""
+        self.add_markers(kms, repeat(OVERIG, len(kms)))
 
     def add_uptriangles(self, kms):
-        """Add upward triangles to bar_axes at specified kms.
-
-        The self.legend_handles_labels receives the patch as well."""
-        ypos = 0.7
-        km_arr = array(kms).reshape(-1, 1)
-        ypos_arr = array([ypos for x in kms]).reshape(-1, 1)
-        offsets = concatenate((km_arr, ypos_arr), axis=1)
-
-        collection = RegularPolyCollection(
-            numsides=3,
-            rotation=0,
-            sizes=(self.polysize,),
-            facecolors=self.colormap(ypos),
-            offsets=offsets,
-            transOffset=self.bar_axes.transData,
-            zorder=self.patch_zorder)
-        self.bar_axes.add_collection(collection)
-
-        line = Line2D((0, 1),
-                      (0, 0),
-                      linestyle='',
-                      marker='^',
-                      markersize=self.legend_markersize,
-                      markeredgewidth=self.legend_markeredgewidth,
-                      markerfacecolor=self.colormap(ypos))
-        label = 'Groene rivieren / ontrekkingen'
-        self.legend_handles.append(line)
-        self.legend_labels.append(label)
+        """Add upward triangles ('Groene rivieren / ontrekkingen') to
+        bar_axes at specified kms."""
+        self.add_markers(kms, repeat(ONTTREKKINGEN, len(kms)))
 
     def add_squares(self, kms):
-        """Add squares to bar_axes at specified kms.
-
-        The self.legend_handles_labels receives the patch as well."""
-        ypos = 0.5
-        km_arr = array(kms).reshape(-1, 1)
-        ypos_arr = array([ypos for x in kms]).reshape(-1, 1)
-        offsets = concatenate((km_arr, ypos_arr), axis=1)
-
-        collection = RegularPolyCollection(
-            numsides=4,
-            rotation=pi / 4,
-            sizes=(self.polysize,),
-            facecolors=self.colormap(ypos),
-            offsets=offsets,
-            transOffset=self.bar_axes.transData,
-            zorder=self.patch_zorder)
-        self.bar_axes.add_collection(collection)
-
-        line = Line2D((0, 1),
-                      (0, 0),
-                      linestyle='',
-                      marker='s',
-                      markersize=self.legend_markersize,
-                      markeredgewidth=self.legend_markeredgewidth,
-                      markerfacecolor=self.colormap(ypos))
-        label = 'Dijken / kades'
-        self.legend_handles.append(line)
-        self.legend_labels.append(label)
+        """Add squares ('Dijken / kades') to bar_axes at specified kms."""
+        self.add_markers(kms, repeat(DIJKEN, len(kms)))
 
     def add_downtriangles(self, kms):
-        """Add downward triangles to bar_axes at specified kms.
-
-        The self.legend_handles_labels receives the patch as well."""
-        ypos = 0.3
-        km_arr = array(kms).reshape(-1, 1)
-        ypos_arr = array([ypos for x in kms]).reshape(-1, 1)
-        offsets = concatenate((km_arr, ypos_arr), axis=1)
-
-        collection = RegularPolyCollection(
-            numsides=3,
-            rotation=pi,
-            sizes=(self.polysize,),
-            facecolors=self.colormap(ypos),
-            offsets=offsets,
-            transOffset=self.bar_axes.transData,
-            zorder=self.patch_zorder)
-        self.bar_axes.add_collection(collection)
-
-        line = Line2D((0, 1),
-                      (0, 0),
-                      linestyle='',
-                      marker='v',
-                      markersize=self.legend_markersize,
-                      markeredgewidth=self.legend_markeredgewidth,
-                      markerfacecolor=self.colormap(ypos))
-        label = 'Retentie'
-        self.legend_handles.append(line)
-        self.legend_labels.append(label)
+        """Add downward triangles ('Retentie') to bar_axes at specified
+        kms."""
+        self.add_markers(kms, repeat(RETENTIE, len(kms)))
 
     def add_circles(self, kms):
-        """Add circles to bar_axes at specified kms.
-
-        The self.legend_handles_labels receives the patch as well."""
-        ypos = 0.1
-        km_arr = array(kms).reshape(-1, 1)
-        ypos_arr = array([ypos for x in kms]).reshape(-1, 1)
-        offsets = concatenate((km_arr, ypos_arr), axis=1)
-
-        collection = CircleCollection(
-            sizes=(self.circlesize,),
-            facecolors=self.colormap(ypos),
-            offsets=offsets,
-            transOffset=self.bar_axes.transData,
-            zorder=self.patch_zorder)
-        self.bar_axes.add_collection(collection)
-        line = Line2D((0, 1),
-                      (0, 0),
-                      linestyle='',
-                      marker='o',
-                      markersize=self.legend_markersize,
-                      markeredgewidth=self.legend_markeredgewidth,
-                      markerfacecolor=self.colormap(ypos))
-        label = 'Knelpunten'
-        self.legend_handles.append(line)
-        self.legend_labels.append(label)
+        """Add circles ('Knelpunten') to bar_axes at specified kms."""
+        self.add_markers(kms, repeat(KNELPUNTEN, len(kms)))
 
     def add_text(self, kms, strs):
-        ylim = self.axes.get_ylim()
-        ypos = ylim[0] + (ylim[1] - ylim[0]) * 0.9
-        for k, t in zip(kms, strs):
-            self.axes.add_artist(Text(k,
-                                      ypos,
-                                      t,
-                                      backgroundcolor='white',
-                                      horizontalalignment='center'))
-            self.axes.axvline(k,
-                   color='#030303',
-                   linestyle='--',
-                   linewidth=1,
-                   zorder=-10,
-                   label='remove_from_legend')
-            self.bar_axes.axvline(k,
-                   color='#030303',
-                   linestyle='--',
-                   linewidth=1,
-                   zorder=-10,
-                   label=t)
+        """Add place names at kms, with reference lines on both axes.
+
+        The lines and names are drawn by draw_places in prepare_draw,
+        when the km range of the graph is known."""
+        self.place_kms.extend(kms)
+        self.place_names.extend(strs)
+
+    @styled
+    def draw_places(self):
+        """Draw the places added with add_text.
+
+        The reference lines of all places are one LineCollection per axes.
+        Names that would overlap a name to their left are left out; the
+        widths of the names are measured with text_width."""
+        kms = asarray(self.place_kms, dtype=float)
+        names = asarray(self.place_names, dtype=object)
+        order = argsort(kms, kind='mergesort')
+        index = km_slice(kms[order], *self.km_range())
+        kms = kms[order][index]
+        names = names[order][index]
+        if not len(names):
+            return
+        segments = zeros((len(kms), 2, 2))
+        segments[:, :, 0] = kms[:, newaxis]
+        segments[:, 1, 1] = 1
+        for axes in (self.axes, self.bar_axes):
+            # x in data coordinates, y in axes coordinates.
+            lines = LineCollection(segments,
+                                   colors='#030303',
+                                   linestyles='dashed',
+                                   linewidths=1,
+                                   zorder=-10,
+                                   transform=axes.get_xaxis_transform())
+            axes.add_collection(lines, autolim=False)
+
+        prop = FontProperties(size=self.fontsize)
+        widths = array([text_width(name, prop, self.dpi) for name in names])
+        x = self.axes.transData.transform(
+            column_stack((kms, zeros(len(kms)))))[:, 0]
+        padding = self.place_padding
+        left = x - widths / 2 - padding
+        right = x + widths / 2 + padding
+        edge = -inf
+        for i in argsort(left, kind='mergesort'):
+            if left[i] < edge:
+                continue
+            edge = right[i]
+            self.axes.text(kms[i],
+                           0.9,
+                           names[i],
+                           size=self.fontsize,
+                           backgroundcolor='white',
+                           horizontalalignment='center',
+                           transform=self.axes.get_xaxis_transform())
 
+    @styled
     def legend(self, handles=None, labels=None):
         handles, labels = self.axes.get_legend_handles_labels()
 
-        # Remove the labels from the vlines
-        def f(tup):
-            return tup[1] != 'remove_from_legend'
-        handles, labels = zip(*filter(f, zip(handles, labels)))
-
-        handles = list(handles)
-        labels = list(labels)
-
         handles.extend(self.legend_handles)
         labels.extend(self.legend_labels)
 
@@ -1,17 +1,163 @@
 # -*- coding: utf-8 -*-
+"""Custom matplotlib scales.
+
+Importing this module has no side effects. The scales are registered
+with matplotlib by register(), which set_xscale and set_yscale call, so
+use those (or call register() first) to select a scale by name::
+
+    scales.set_yscale(axes, 'precipitation')
+"""
+from __future__ import division
+
+import numpy as np
+from numpy import ma
 
 from matplotlib import transforms
 from matplotlib import scale
+from matplotlib.dates import DateFormatter
+from matplotlib.dates import DayLocator
+from matplotlib.dates import MonthLocator
+from matplotlib.ticker import FixedLocator
+from matplotlib.ticker import FormatStrFormatter
+from matplotlib.ticker import Formatter
+
+from nens_graph.common import EPOCH
+
+# Folded dates end up in this year; a leap year, so February 29 fits.
+REFERENCE_YEAR = 2000
+
+
+def cycle_bounds(month=None):
+    """Return the first and last date number of the reference cycle: the
+    month in REFERENCE_YEAR, or the whole year if month is None."""
+    year = np.datetime64('%d' % REFERENCE_YEAR, 'Y')
+    if month is None:
+        bounds = np.array([year, year + 1], dtype='datetime64[D]')
+    else:
+        first = year.astype('datetime64[M]') + (month - 1)
+        bounds = np.array([first, first + 1], dtype='datetime64[D]')
+    return tuple(bounds.astype(float) + EPOCH)
+
+
+def fold_dates(datenums, month=None):
+    """Return date numbers folded onto the reference cycle.
+
+    Every date is moved to the same moment in REFERENCE_YEAR. If month is
+    given (1 - 12), dates in other months become nan, so that only that
+    month of every year remains."""
+    datenums = np.asarray(datenums, dtype=float)
+    first, last = cycle_bounds(month)
+    days = np.floor(datenums - EPOCH)
+    valid = np.isfinite(days)
+    months = np.where(valid, days, 0).astype('datetime64[D]').astype(
+        'datetime64[M]')
+    month_index = months.astype(int) % 12
+    if month is not None:
+        valid &= month_index + 1 == month
+    # Fold by calendar day, so that May 3 stays May 3 in leap years too.
+    reference = np.datetime64('%d-01' % REFERENCE_YEAR, 'M') + month_index
+    result = (datenums - months.astype('datetime64[D]').astype(float) +
+              reference.astype('datetime64[D]').astype(float))
+    # Dates in the reference cycle stay where they are, including its
+    # end, so that the axis limits keep their order.
+    inside = (datenums >= first) & (datenums <= last)
+    result = np.where(inside, datenums, result)
+    return np.where(valid | inside, result, np.nan)
+
+
+def break_cycles(datenums, values, month=None):
+    """Return folded dates and values, with a nan value inserted where a
+    cycle ends, so that lines are not drawn back across the graph."""
+    folded = fold_dates(datenums, month=month)
+    values = np.asarray(values, dtype=float)
+    breaks = np.flatnonzero(np.diff(folded) < 0) + 1
+    return (np.insert(folded, breaks, folded[breaks - 1]),
+            np.insert(values, breaks, np.nan))
+
 
 class RestrictToMonthScale(scale.ScaleBase):
-    """Scales data to a specific repeating period in time."""
-    pass
+    """Scales data to a specific repeating period in time.
+
+    Dates (matplotlib date numbers) of any number of years are folded
+    onto one month or year, see fold_dates. The axis limits are always
+    that month or year in REFERENCE_YEAR. Use break_cycles on the data of
+    lines, otherwise the end of each cycle is connected to the start of
+    the next one.
+
+    Select it with ``axes.set_xscale('restrict_to_month', month=5)``,
+    leave out month to fold onto a year.
+    """
+    name = 'restrict_to_month'
+
+    def __init__(self, axis, **kwargs):
+        scale.ScaleBase.__init__(self)
+        self.month = kwargs.pop('month', None)
+        if self.month is not None and not 1 <= self.month <= 12:
+            raise ValueError("month must be in 1 - 12")
+
+    def get_transform(self):
+        return FoldTransform(self.month)
+
+    def set_default_locators_and_formatters(self, axis):
+        if self.month is None:
+            axis.set_major_locator(MonthLocator())
+            axis.set_major_formatter(DateFormatter('%b'))
+        else:
+            axis.set_major_locator(DayLocator(bymonthday=(1, 8, 15, 22)))
+            axis.set_major_formatter(DateFormatter('%d %b'))
+        axis.set_minor_locator(DayLocator())
+        axis.set_minor_formatter(DateFormatter(''))
+
+    def limit_range_for_scale(self, vmin, vmax, minpos):
+        return cycle_bounds(self.month)
+
+
+class FoldTransform(transforms.Transform):
+    input_dims = 1
+    output_dims = 1
+    is_separable = True
+    has_inverse = True
+
+    def __init__(self, month=None):
+        transforms.Transform.__init__(self)
+        self.month = month
+
+    def transform_non_affine(self, a):
+        return fold_dates(a, month=self.month)
+
+    def inverted(self):
+        return UnfoldTransform(self.month)
+
+
+class UnfoldTransform(transforms.Transform):
+    """Inverse of FoldTransform. Folded dates are in the reference cycle
+    and, of all dates that fold onto them, they are the natural ones to
+    return, so this is the identity."""
+    input_dims = 1
+    output_dims = 1
+    is_separable = True
+    has_inverse = True
+
+    def __init__(self, month=None):
+        transforms.Transform.__init__(self)
+        self.month = month
+
+    def transform_non_affine(self, a):
+        return np.asarray(a, dtype=float)
+
+    def inverted(self):
+        return FoldTransform(self.month)
+
+
+def restrict_to_month(axes, month=None):
+    """Set the x scale of axes to fold dates onto month (or a year) and
+    the x limits to that month."""
+    set_xscale(axes, RestrictToMonthScale.name, month=month)
+    axes.set_xlim(cycle_bounds(month))
 
 
 # Copied from http://matplotlib.sourceforge.net/api/axes_api.html
-from matplotlib import scale as mscale
-from matplotlib import transforms as mtransforms
-class MercatorLatitudeScale(mscale.ScaleBase):
+class MercatorLatitudeScale(scale.ScaleBase):
     """
     Scales data in range -pi/2 to pi/2 (-90 to 90 degrees) using
     the system used to scale latitudes in a Mercator projection.
@@ -45,7 +191,7 @@ class MercatorLatitudeScale(mscale.ScaleBase):
 
         thresh: The degree above which to crop the data.
         """
-        mscale.ScaleBase.__init__(self)
+        scale.ScaleBase.__init__(self)
         thresh = kwargs.pop("thresh", (85 / 180.0) * np.pi)
         if thresh >= np.pi / 2.0:
             raise ValueError("thresh must be less than pi/2")
@@ -97,7 +243,7 @@ class MercatorLatitudeScale(mscale.ScaleBase):
         """
         return max(vmin, -self.thresh), min(vmax, self.thresh)
 
-    class MercatorLatitudeTransform(mtransforms.Transform):
+    class MercatorLatitudeTransform(transforms.Transform):
         # There are two value members that must be defined.
         # ``input_dims`` and ``output_dims`` specify number of input
         # dimensions and output dimensions to the transformation.
@@ -111,10 +257,10 @@ class MercatorLatitudeScale(mscale.ScaleBase):
         is_separable = True
 
         def __init__(self, thresh):
-            mtransforms.Transform.__init__(self)
+            transforms.Transform.__init__(self)
             self.thresh = thresh
 
-        def transform(self, a):
+        def transform_non_affine(self, a):
             """
             This transform takes an Nx1 ``numpy`` array and returns a
             transformed copy.  Since the range of the Mercator scale
@@ -125,12 +271,16 @@ class MercatorLatitudeScale(mscale.ScaleBase):
             ``transform`` method *must* return an array that is the
             same shape as the input array, since these values need to
             remain synchronized with values in the other dimension.
+
+            Masking is slow, so it is only done when there actually are
+            values out of range.
             """
-            masked = ma.masked_where((a < -self.thresh) | (a > self.thresh), a)
-            if masked.mask.any():
+            a = np.asarray(a)
+            outside = np.abs(a) > self.thresh
+            if outside.any():
+                masked = ma.masked_where(outside, a)
                 return ma.log(np.abs(ma.tan(masked) + 1.0 / ma.cos(masked)))
-            else:
-                return np.log(np.abs(np.tan(a) + 1.0 / np.cos(a)))
+            return np.log(np.abs(np.tan(a) + 1.0 / np.cos(a)))
 
         def inverted(self):
             """
@@ -139,37 +289,160 @@ class MercatorLatitudeScale(mscale.ScaleBase):
             """
             return MercatorLatitudeScale.InvertedMercatorLatitudeTransform(self.thresh)
 
-    class InvertedMercatorLatitudeTransform(mtransforms.Transform):
+    class InvertedMercatorLatitudeTransform(transforms.Transform):
         input_dims = 1
         output_dims = 1
         is_separable = True
 
         def __init__(self, thresh):
-            mtransforms.Transform.__init__(self)
+            transforms.Transform.__init__(self)
             self.thresh = thresh
 
-        def transform(self, a):
+        def transform_non_affine(self, a):
             return np.arctan(np.sinh(a))
 
         def inverted(self):
             return MercatorLatitudeScale.MercatorLatitudeTransform(self.thresh)
 
-# Now that the Scale class has been defined, it must be registered so
-# that ``matplotlib`` can find it.
-mscale.register_scale(MercatorLatitudeScale)
+# Ticks of SqrtScale.
+SQRT_TICKS = (0, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
 
-from pylab import *
-import numpy as np
 
-t = arange(-180.0, 180.0, 0.1)
-s = t / 360.0 * np.pi
+class SqrtScale(scale.ScaleBase):
+    """Square root scale, for precipitation graphs with peaks that would
+    flatten everything else on a linear scale. Negative values are
+    mirrored."""
+    name = 'sqrt'
+
+    def __init__(self, axis, **kwargs):
+        scale.ScaleBase.__init__(self)
+
+    def get_transform(self):
+        return SqrtTransform()
+
+    def set_default_locators_and_formatters(self, axis):
+        axis.set_major_locator(FixedLocator(SQRT_TICKS))
+        axis.set_major_formatter(FormatStrFormatter('%g'))
+
+
+class SqrtTransform(transforms.Transform):
+    input_dims = 1
+    output_dims = 1
+    is_separable = True
+    has_inverse = True
+
+    def transform_non_affine(self, a):
+        a = np.asarray(a, dtype=float)
+        return np.sign(a) * np.sqrt(np.abs(a))
+
+    def inverted(self):
+        return SquareTransform()
+
+
+class SquareTransform(transforms.Transform):
+    input_dims = 1
+    output_dims = 1
+    is_separable = True
+    has_inverse = True
+
+    def transform_non_affine(self, a):
+        a = np.asarray(a, dtype=float)
+        return np.sign(a) * a * a
+
+    def inverted(self):
+        return SqrtTransform()
+
+
+# Ticks of PrecipitationScale, in mm (per hour or per period).
+PRECIPITATION_TICKS = (0, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200,
+                       500, 1000)
+
+
+class PrecipitationScale(scale.ScaleBase):
+    """Logarithmic scale for precipitation intensities that includes zero.
+
+    The transform is log10(1 + value / linear): about linear below the
+    linear keyword argument (default 1), logarithmic above it. Negative
+    values are not shown."""
+    name = 'precipitation'
+
+    def __init__(self, axis, **kwargs):
+        scale.ScaleBase.__init__(self)
+        self.linear = kwargs.pop('linear', 1)
+        if self.linear <= 0:
+            raise ValueError("linear must be positive")
+
+    def get_transform(self):
+        return PrecipitationTransform(self.linear)
+
+    def set_default_locators_and_formatters(self, axis):
+        axis.set_major_locator(FixedLocator(PRECIPITATION_TICKS))
+        axis.set_major_formatter(FormatStrFormatter('%g'))
+
+    def limit_range_for_scale(self, vmin, vmax, minpos):
+        return max(vmin, 0), max(vmax, 0)
+
+
+class PrecipitationTransform(transforms.Transform):
+    input_dims = 1
+    output_dims = 1
+    is_separable = True
+    has_inverse = True
+
+    def __init__(self, linear):
+        transforms.Transform.__init__(self)
+        self.linear = linear
+
+    def transform_non_affine(self, a):
+        a = np.asarray(a, dtype=float)
+        return np.log10(1 + np.maximum(a, 0) / self.linear)
+
+    def inverted(self):
+        return InvertedPrecipitationTransform(self.linear)
+
+
+class InvertedPrecipitationTransform(transforms.Transform):
+    input_dims = 1
+    output_dims = 1
+    is_separable = True
+    has_inverse = True
+
+    def __init__(self, linear):
+        transforms.Transform.__init__(self)
+        self.linear = linear
+
+    def transform_non_affine(self, a):
+        a = np.asarray(a, dtype=float)
+        return (10 ** a - 1) * self.linear
+
+    def inverted(self):
+        return PrecipitationTransform(self.linear)
+
+
+SCALES = (MercatorLatitudeScale,
+          RestrictToMonthScale,
+          SqrtScale,
+          PrecipitationScale)
+
+_registered = False
+
+
+def register():
+    """Register SCALES with matplotlib. Only the first call does so."""
+    global _registered
+    if not _registered:
+        for scale_class in SCALES:
+            scale.register_scale(scale_class)
+        _registered = True
+
 
-plot(t, s, '-', lw=2)
-gca().set_yscale('mercator')
+def set_xscale(axes, name, **kwargs):
+    """Like axes.set_xscale, registering the scales here first."""
+    register()
+    axes.set_xscale(name, **kwargs)
 
-xlabel('Longitude')
-ylabel('Latitude')
-title('Mercator: Projection of the Oppressor')
-grid(True)
 
-show()
+def set_yscale(axes, name, **kwargs):
+    """Like axes.set_yscale, registering the scales here first."""
+    register()
+    axes.set_yscale(name, **kwargs)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Sparklines: tiny line graphs without axes, for tables of series.
+
+A Sparkline draws its series as paths straight onto an Agg renderer,
+without a figure, axes, locators or text. Many sparklines can be drawn
+into one image (a sprite sheet) with render_sprites, which returns where
+each one ended up.
+"""
+from __future__ import division
+
+import numpy
+
+from nens_graph.common import DPI
+from nens_graph.common import as_source
+from nens_graph.common import decimate
+from nens_graph.common import to_datenums
+from nens_graph.common import write_png
+
+from matplotlib.colors import colorConverter
+from matplotlib.path import Path
+from matplotlib.transforms import Affine2D
+from matplotlib.transforms import Bbox
+
+
+class Sparkline(object):
+    """Tiny line graph of a timeseries.
+
+    Constructor arguments:
+    - timeseries: anything common.as_source accepts
+    - width, height (optional, default: 80, 20): size in pixels
+    - start_date, end_date (optional): the period, default the extent of
+      the series
+    - vmin, vmax (optional): the values at the bottom and top, default
+      the minimum and maximum of the series; give them to sparklines
+      that should be compared
+    - color, linewidth (optional): of the line
+    - minmax (optional, default: False): mark the minimum and maximum
+    - last (optional, default: False): mark the last value
+    - padding (optional, default: 2): pixels around the line, room for
+      the markers
+    - dpi (optional, default: 72)
+
+    The series is read at about one event per pixel and decimated, so
+    that large series are cheap.
+    """
+    MIN_COLOR = '#1f77b4'
+    MAX_COLOR = '#d62728'
+    LAST_COLOR = '#ff7f0e'
+    MARKER_SIZE = 1.5  # radius in pixels
+
+    def __init__(self, timeseries, width=80, height=20, start_date=None,
+                 end_date=None, vmin=None, vmax=None, color='#444444',
+                 linewidth=1, minmax=False, last=False, padding=2,
+                 dpi=DPI):
+        self.width = width
+        self.height = height
+        self.vmin = vmin
+        self.vmax = vmax
+        self.color = color
+        self.linewidth = linewidth
+        self.minmax = minmax
+        self.last = last
+        self.padding = padding
+        self.dpi = dpi
+        self.responseobject = None
+
+        source = as_source(timeseries)
+        hints = {}
+        if start_date is not None and end_date is not None:
+            start, end = to_datenums((start_date, end_date))
+            hints = {'start': start,
+                     'end': end,
+                     'resolution': (end - start) / width}
+        else:
+            extent = source.get_extent()
+            start, end = extent if extent else (0, 1)
+        self.start, self.end = start, end
+        events = source.get_columns(**hints).valid()
+        if len(events) > 4 * width and end > start:
+            events = decimate(events, (end - start) / width)
+        self.dates = events.dates
+        self.values = events.values
+
+    def transform(self, x0=0, y0=0):
+        """Return the transform from (date, value) to pixels, for a
+        sparkline with its lower left corner at (x0, y0)."""
+        vmin = self.values.min() if self.vmin is None else self.vmin
+        vmax = self.values.max() if self.vmax is None else self.vmax
+        if vmax <= vmin:
+            # A flat line in the middle.
+            vmin, vmax = vmin - 1, vmin + 1
+        span = self.end - self.start or 1
+        inner_width = self.width - 2 * self.padding
+        inner_height = self.height - 2 * self.padding
+        return (Affine2D()
+                .translate(-self.start, -vmin)
+                .scale(inner_width / span, inner_height / (vmax - vmin))
+                .translate(x0 + self.padding, y0 + self.padding))
+
+    def draw(self, renderer, x0=0, y0=0):
+        """Draw the sparkline on renderer (an Agg renderer), with its
+        lower left corner at (x0, y0) pixels from the lower left corner of
+        the image."""
+        if not len(self.values):
+            return
+        transform = self.transform(x0, y0)
+        gc = renderer.new_gc()
+        gc.set_clip_rectangle(
+            Bbox.from_bounds(x0, y0, self.width, self.height))
+        gc.set_antialiased(True)
+        gc.set_foreground(self.color)
+        gc.set_linewidth(self.linewidth)
+        gc.set_joinstyle('round')
+        gc.set_capstyle('round')
+        path = Path(numpy.column_stack((self.dates, self.values)))
+        renderer.draw_path(gc, path, transform)
+
+        markers = []
+        if self.minmax:
+            markers.append((numpy.argmin(self.values), self.MIN_COLOR))
+            markers.append((numpy.argmax(self.values), self.MAX_COLOR))
+        if self.last:
+            markers.append((len(self.values) - 1, self.LAST_COLOR))
+        marker_path = Path.unit_circle()
+        marker_transform = Affine2D().scale(self.MARKER_SIZE)
+        gc.set_linewidth(0)
+        for index, color in markers:
+            point = Path([[self.dates[index], self.values[index]]])
+            renderer.draw_markers(gc, marker_path, marker_transform, point,
+                                  transform, colorConverter.to_rgb(color))
+        gc.restore()
+
+    def render(self, response=None):
+        """Write the sparkline as png to response, with a transparent
+        background."""
+        if response is None:
+            response = self.responseobject
+        if response is None:
+            raise TypeError('Expected response object, not None.')
+        from matplotlib.backends.backend_agg import RendererAgg
+        renderer = RendererAgg(self.width, self.height, self.dpi)
+        self.draw(renderer)
+        write_png(renderer, response, self.dpi)
+        return response
+
+    def png_response(self, response=None):
+        return self.render(response=response)
+
+
+def render_sprites(sparklines, response, ncols=1, dpi=DPI):
+    """Draw sparklines into one png (a sprite sheet) in response.
+
+    The sparklines are placed row by row, ncols per row, in cells as
+    large as the largest sparkline. Return the (x, y) offsets of the
+    sparklines in pixels from the top left corner of the image, as CSS
+    background positions want them (negated)."""
+    from matplotlib.backends.backend_agg import RendererAgg
+    sparklines = list(sparklines)
+    if not sparklines:
+        return []
+    cell_width = max(sparkline.width for sparkline in sparklines)
+    cell_height = max(sparkline.height for sparkline in sparklines)
+    ncols = max(min(ncols, len(sparklines)), 1)
+    nrows = -(-len(sparklines) // ncols)
+    width, height = ncols * cell_width, nrows * cell_height
+    renderer = RendererAgg(width, height, dpi)
+    offsets = []
+    for index, sparkline in enumerate(sparklines):
+        row, col = divmod(index, ncols)
+        x, y = col * cell_width, row * cell_height
+        # Agg counts from the bottom.
+        sparkline.draw(renderer, x, height - y - sparkline.height)
+        offsets.append((x, y))
+    write_png(renderer, response, dpi)
+    return offsets
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""Tests, run with bin/test (nose)."""
+from __future__ import division
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+
+import iso8601
+import numpy
+from matplotlib.image import imread
+
+from nens_graph.common import ArraySource
+from nens_graph.common import CSV_BLOCKSIZE
+from nens_graph.common import DateGridGraph
+from nens_graph.common import as_source
+from nens_graph.common import parse_dates
+from nens_graph.common import read_csv
+from nens_graph.common import render_graphs
+from nens_graph.pyramid import Pyramid
+from nens_graph.river import RiverGraph
+
+
+def build_graph(index):
+    """Return one of a set of graphs with different fontsizes and dpis."""
+    fontsize = (8, 10, 14)[index % 3]
+    dpi = (72, 96)[index % 4 // 2]
+    if index % 2:
+        graph = DateGridGraph(width=400, height=300,
+                              fontsize=fontsize, dpi=dpi)
+        dates = numpy.arange(730000, 730100, 0.1)
+        graph.axes.plot(dates, numpy.sin(dates + index),
+                        label='serie %d' % index)
+        graph.legend()
+    else:
+        graph = RiverGraph(width=400, height=300, fontsize=fontsize,
+                           dpi=dpi)
+        kms = numpy.linspace(0, 100, 1000)
+        graph.add_profile(kms, numpy.sin(kms / 5 + index),
+                          label='profiel %d' % index)
+        graph.add_text(numpy.arange(0, 100, 7.),
+                       ['P%d' % place for place in range(15)])
+    return graph
+
+
+def digest(response):
+    return hashlib.md5(response.getvalue()).hexdigest()
+
+
+def hourly_strings(count, suffix=''):
+    """Return count hourly date strings from 2012-01-01, with suffix."""
+    start = numpy.datetime64('2012-01-01T00:00:00', 'us')
+    return ['%s%s' % (str(start + numpy.timedelta64(hour, 'h'))[:19].replace(
+        'T', ' '), suffix) for hour in range(count)]
+
+
+class ParseDatesTest(unittest.TestCase):
+
+    def setUp(self):
+        # Count the strings that parse_dates leaves to iso8601.
+        self.parse_date = iso8601.parse_date
+        self.fallbacks = 0
+
+        def parse_date(*args, **kwargs):
+            self.fallbacks += 1
+            return self.parse_date(*args, **kwargs)
+        iso8601.parse_date = parse_date
+
+    def tearDown(self):
+        iso8601.parse_date = self.parse_date
+
+    def expected(self, strings):
+        result = []
+        for string in strings:
+            dt = self.parse_date(string)
+            result.append(numpy.datetime64(
+                dt.replace(tzinfo=None) - dt.utcoffset(), 'us'))
+        return numpy.array(result)
+
+    def test_fast_path(self):
+        for suffix in ('', 'Z', '+01:00', '-0130', '+00:00'):
+            strings = hourly_strings(100, suffix)
+            self.fallbacks = 0
+            result = parse_dates(strings)
+            self.assertEqual(self.fallbacks, 0, suffix)
+            self.assertTrue((result == self.expected(strings)).all(), suffix)
+
+    def test_mixed_offsets(self):
+        strings = ['2012-01-01 10:00:00+01:00', '2012-01-01 10:00:00-01:00']
+        self.assertEqual(parse_dates(strings).tolist(),
+                         self.expected(strings).tolist())
+        self.assertEqual(self.fallbacks, 0)
+
+    def test_other_formats(self):
+        strings = ['2012-01-01T10:00:00+01:00', '2012-1-5', '20120105T1000Z']
+        self.assertEqual(parse_dates(strings).tolist(),
+                         self.expected(strings).tolist())
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_dates, ['2012-01-01', 'x'])
+        self.assertRaises(ValueError, parse_dates, ['2012-02-30'])
+        result = parse_dates(['2012-01-01', 'x'], invalid='nat')
+        self.assertTrue(numpy.isnat(result[1]) if hasattr(numpy, 'isnat')
+                        else str(result[1]) == 'NaT')
+
+
+class ReadCsvTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'export.csv')
+        self.parse_date = iso8601.parse_date
+
+        def parse_date(*args, **kwargs):
+            self.fail('read_csv left %r to iso8601' % (args, ))
+        iso8601.parse_date = parse_date
+
+    def tearDown(self):
+        iso8601.parse_date = self.parse_date
+        shutil.rmtree(self.directory)
+
+    def test_timeseries_csv_round_trip(self):
+        dates = 730000 + numpy.arange(1000) / 24
+        values = numpy.sin(numpy.arange(1000.))
+        values[10] = numpy.nan
+        graph = DateGridGraph()
+        graph.stored_timeseries.append(
+            ('serie, 1', ArraySource(dates, values)))
+        graph.stored_timeseries.append(
+            ('serie 2', ArraySource(dates[:10], values[:10] * 2)))
+        with open(self.filename, 'wb') as response:
+            graph.timeseries_csv(response)
+        for blocksize in (CSV_BLOCKSIZE, 4096):
+            sources = read_csv(self.filename, blocksize=blocksize)
+            self.assertEqual([source.label for source in sources],
+                             ['serie, 1', 'serie 2'])
+            for source, (label, expected) in zip(sources,
+                                                 graph.stored_timeseries):
+                numpy.testing.assert_allclose(source.columns.dates,
+                                              expected.columns.dates,
+                                              rtol=0, atol=1e-8)
+                numpy.testing.assert_array_equal(source.columns.values,
+                                                 expected.columns.values)
+
+
+class GraphItem(object):
+    """Stands in for the graph items of lizard, only has a layout."""
+
+    def __init__(self, **layout):
+        self.layout = layout
+
+    def layout_dict(self):
+        return self.layout
+
+
+class UnsizedSource(ArraySource):
+    """Source that must not be read as a whole."""
+
+    def __len__(self):
+        raise AssertionError('len() reads the whole source')
+
+
+class TupleTimeseriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dates = 730000 + numpy.arange(48) / 24
+        self.values = numpy.arange(48.)
+        self.graph = DateGridGraph(width=400, height=300)
+        self.graph.axes.set_xlim(self.dates[0], self.dates[-1])
+
+    def test_as_source(self):
+        source = as_source((self.dates, self.values))
+        self.assertEqual(len(source), 48)
+        columns = source.get_columns()
+        numpy.testing.assert_array_equal(columns.dates, self.dates)
+        numpy.testing.assert_array_equal(columns.values, self.values)
+        self.assertTrue(as_source(source) is source)
+
+    def test_export(self):
+        self.graph.line_from_single_ts(
+            (self.dates, self.values), GraphItem(label='lijn'))
+        self.graph.bar_from_single_ts(
+            (self.dates, self.values), GraphItem(label='staaf'), 1 / 24,
+            bottom_ts=UnsizedSource(self.dates, self.values))
+        rows = self.graph.timeseries_as_list()
+        self.assertEqual([row['data'] for row in rows
+                          if row['type'] == 'title'], ['lijn', 'staaf'])
+        self.assertEqual(len([row for row in rows
+                              if row['type'] == 'event']), 96)
+        response = BytesIO()
+        self.graph.timeseries_csv(response)
+        self.assertEqual(len(response.getvalue().splitlines()), 100)
+
+
+class RenderBlittedTest(unittest.TestCase):
+
+    def build(self, slope):
+        graph = DateGridGraph(width=400, height=300)
+        graph.axes.plot([730000, 730004], [1, 2 + slope], label='dynamisch')
+        graph.axes.plot([730000, 730004], [3, 5], lw=8, label='statisch')
+        graph.axes.set_xlim(730000, 730004)
+        graph.axes.set_ylim(0, 10)
+        graph.legend()
+        return graph
+
+    def pixels(self, response):
+        return imread(BytesIO(response.getvalue()))
+
+    def test_same_as_render(self):
+        # The second graph is drawn over the background of the first.
+        for slope in (0, 3):
+            expected = self.build(slope).render(BytesIO())
+            graph = self.build(slope)
+            graph.set_dynamic(graph.axes.lines[0])
+            response = graph.render_blitted(('RenderBlittedTest', ),
+                                            BytesIO())
+            numpy.testing.assert_array_equal(self.pixels(response),
+                                             self.pixels(expected))
+
+
+class PyramidTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Twenty days of ten minute values, with a gap.
+        self.dates = 730000 + numpy.arange(2880) / 144
+        self.values = numpy.sin(numpy.arange(2880) / 50)
+        self.values[1000:1100] = numpy.nan
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pyramid(self, *pieces):
+        """Return a pyramid built from the first piece and updated with
+        the others, pieces being slices of the test data."""
+        pyramid = Pyramid(os.path.join(self.directory, str(len(
+                        os.listdir(self.directory)))))
+        pyramid.build((self.dates[pieces[0]], self.values[pieces[0]]))
+        for piece in pieces[1:]:
+            pyramid.update((self.dates[piece], self.values[piece]))
+        return pyramid
+
+    def assertSameBins(self, pyramid, expected):
+        for width in expected.levels:
+            bins = pyramid.get_bins(width)
+            expected_bins = expected.get_bins(width)
+            for field in ('date', 'min', 'max', 'count'):
+                numpy.testing.assert_array_equal(bins[field],
+                                                 expected_bins[field])
+            numpy.testing.assert_allclose(bins['sum'], expected_bins['sum'])
+
+    def test_update(self):
+        expected = self.pyramid(slice(None))
+        # Pieces that end within a bin of every level.
+        self.assertSameBins(self.pyramid(slice(0, 1003),
+                                         slice(1003, 2001),
+                                         slice(2001, None)), expected)
+        # Older events than the stored ones.
+        self.assertSameBins(self.pyramid(slice(1500, None),
+                                         slice(0, 1500)), expected)
+
+
+class StyleTest(unittest.TestCase):
+
+    def test_defaults_for_direct_text(self):
+        graph = DateGridGraph(fontsize=14)
+        ylabel = graph.axes.set_ylabel('foo')
+        self.assertEqual(ylabel.get_fontsize(), 10)
+
+    def test_styles_are_scoped(self):
+        large = DateGridGraph(fontsize=14)
+        default = DateGridGraph()
+        for graph, fontsize in ((large, 14), (default, 10)):
+            graph.axes.set_xlim(730000, 730100)
+            graph.png_response(BytesIO())
+            tick = graph.axes.xaxis.get_major_ticks()[0]
+            self.assertEqual(tick.label1.get_fontsize(), fontsize)
+
+
+class RenderGraphsStressTest(unittest.TestCase):
+    """Graphs with mixed styles, built and rendered in threads, must be
+    the same as graphs built and rendered one by one."""
+    count = 24
+    rounds = 2
+
+    def serial_digests(self):
+        digests = []
+        for index in range(self.count):
+            graph = build_graph(index)
+            graph.responseobject = BytesIO()
+            graph.png_response()
+            digests.append(digest(graph.responseobject))
+        return digests
+
+    def test_threads(self):
+        expected = self.serial_digests()
+        for round_ in range(self.rounds):
+            graphs = [None] * self.count
+
+            def build(index):
+                graphs[index] = build_graph(index)
+
+            builders = [threading.Thread(target=build, args=(index,))
+                        for index in range(self.count)]
+            for builder in builders:
+                builder.start()
+            for builder in builders:
+                builder.join()
+            responses = render_graphs(graphs, threads=8)
+            self.assertEqual([digest(response) for response in responses],
+                             expected)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Time tiles: graphs cut into fixed size tiles along the time axis.
+
+Like map tiles, but for time. At zoom level z the time axis is divided
+into tiles of ROOT_SPAN / 2 ** z days, counted from ORIGIN, and every
+tile is TILE_WIDTH pixels wide. A tile (series set, zoom, index) always
+looks the same, whatever period a client is looking at, so tiles can be
+cached and shared: panning only needs the tiles that come into view.
+
+Tiles hold just the data. The y axis is a separate image (YAxisGraph)
+and the x axis is left to the client, with the ticks of time_ticks.
+"""
+from __future__ import division
+
+import hashlib
+import json
+import math
+
+from nens_graph.common import EPOCH
+from nens_graph.common import LessTicksAutoDateLocator
+from nens_graph.common import MultilineAutoDateFormatter
+from nens_graph.common import NensGraph
+from nens_graph.common import as_source
+from nens_graph.common import source_hints
+from nens_graph.common import styled
+from nens_graph.common import to_datenums
+
+from matplotlib.ticker import MaxNLocator
+
+ORIGIN = EPOCH
+ROOT_SPAN = 2 ** 14  # days, about 45 years
+TILE_WIDTH = 256
+TILE_HEIGHT = 256
+
+
+def tile_span(zoom):
+    """Return the number of days in a tile at zoom."""
+    return ROOT_SPAN / 2 ** zoom
+
+
+def tile_bounds(zoom, index):
+    """Return (start, end) date numbers of a tile."""
+    span = tile_span(zoom)
+    start = ORIGIN + index * span
+    return start, start + span
+
+
+def tile_range(start, end, zoom):
+    """Return the indexes of the tiles at zoom that cover start to end
+    (date numbers, datetimes or datetime64 values)."""
+    start, end = to_datenums((start, end))
+    span = tile_span(zoom)
+    first = int(math.floor((start - ORIGIN) / span))
+    last = int(math.ceil((end - ORIGIN) / span))
+    return range(first, max(last, first + 1))
+
+
+def zoom_level(start, end, width, tile_width=TILE_WIDTH):
+    """Return the zoom level for showing start to end in width pixels:
+    the first level that has at least as many pixels per day. Raise
+    ValueError if end is not after start, or width is not positive."""
+    start, end = to_datenums((start, end))
+    if end <= start or width <= 0:
+        raise ValueError('Need a period and a width, got %r to %r in %r '
+                         'pixels.' % (start, end, width))
+    pixels_per_day = width / (end - start)
+    return max(int(math.ceil(
+        math.log(pixels_per_day * ROOT_SPAN / tile_width, 2))), 0)
+
+
+def time_ticks(start, end, width):
+    """Return the date ticks for start to end in width pixels, as (x,
+    label) pairs, x in pixels from start. The ticks and (multiline)
+    labels are those of DateGridGraph, computed without drawing."""
+    start, end = to_datenums((start, end))
+    locator = LessTicksAutoDateLocator()
+    locator.create_dummy_axis()
+    locator.set_view_interval(start, end)
+    locator.set_data_interval(start, end)
+    locs = [loc for loc in locator() if start <= loc <= end]
+    if not locs:
+        return []
+    formatter = MultilineAutoDateFormatter(locator, None)
+    formatter.tickinfo = formatter.Tickinfo(locs)
+    return [((loc - start) / (end - start) * width, formatter(loc, i))
+            for i, loc in enumerate(locs)]
+
+
+class TileGraph(NensGraph):
+    """One time tile of a series set: only lines, no axes or margins.
+
+    Constructor arguments, besides those of NensGraph:
+    - zoom, index: the tile
+    - ylim: (bottom, top), the same for all tiles of the series set
+    - series_key: a string that identifies the series set (and the
+      version of its data), for cache_key
+
+    Width and height default to TILE_WIDTH and TILE_HEIGHT. The
+    background is transparent, so clients can put a grid under tiles.
+    """
+
+    @styled
+    def __init__(self, zoom, index, ylim, series_key='', **kwargs):
+        kwargs.setdefault('width', TILE_WIDTH)
+        kwargs.setdefault('height', TILE_HEIGHT)
+        super(TileGraph, self).__init__(**kwargs)
+        self.zoom = zoom
+        self.index = index
+        self.ylim = tuple(ylim)
+        self.series_key = series_key
+        self.start, self.end = tile_bounds(zoom, index)
+
+        self.figure.patch.set_alpha(0)
+        self.axes = self.figure.add_axes((0, 0, 1, 1))
+        self.axes.set_axis_off()
+        self.axes.set_xlim(self.start, self.end)
+        self.axes.set_ylim(*self.ylim)
+        self.axes.set_autoscale_on(False)
+
+    def source_hints(self):
+        """Return the range and resolution hints for series sources.
+        The resolution is the same for all tiles at a zoom level, so the
+        lines of neighbouring tiles meet."""
+        return source_hints(self.start, self.end, self.width)
+
+    @styled
+    def add_series(self, timeseries, **kwargs):
+        """Plot timeseries (anything common.as_source accepts) as a line.
+        Kwargs are passed to matplotlib's plot method."""
+        source = as_source(timeseries)
+        events = source.get_columns(**self.source_hints()).valid()
+        kwargs.setdefault('label', source.label)
+        return self.axes.plot(events.dates, events.values, **kwargs)
+
+    def cache_key(self):
+        """Return a key for the image of this tile: a digest of the
+        series key, ylim, size and style, then zoom and index, like
+        'digest/zoom/index'."""
+        data = json.dumps([self.series_key, self.ylim, self.width,
+                           self.height, sorted(self.rc.items())],
+                          sort_keys=True, default=repr)
+        digest = hashlib.md5(data.encode('utf-8')).hexdigest()
+        return '%s/%d/%d' % (digest, self.zoom, self.index)
+
+
+class YAxisGraph(NensGraph):
+    """The y axis of a series set, to show next to its tiles.
+
+    Constructor arguments, besides those of NensGraph:
+    - ylim: (bottom, top), as given to the tiles
+    - ylabel (optional)
+
+    Height defaults to TILE_HEIGHT, width to 60 pixels. The axis is at
+    the right edge and spans the full height, like the tiles.
+    """
+
+    @styled
+    def __init__(self, ylim, ylabel=None, **kwargs):
+        kwargs.setdefault('width', 60)
+        kwargs.setdefault('height', TILE_HEIGHT)
+        super(YAxisGraph, self).__init__(**kwargs)
+        self.axes = self.figure.add_axes(
+            (1 - 1 / self.width, 0, 1 / self.width, 1))
+        self.axes.set_ylim(*ylim)
+        # Ticks at the edges would be cut in half.
+        self.axes.yaxis.set_major_locator(MaxNLocator(prune='both'))
+        self.axes.xaxis.set_visible(False)
+        for side in ('top', 'bottom', 'right'):
+            self.axes.spines[side].set_visible(False)
+        self.axes.yaxis.set_ticks_position('left')
+        if ylabel:
+            self.axes.set_ylabel(ylabel)